@@ -0,0 +1,58 @@
+import json
+
+BABYAI_ACTIONS = ['turn left', 'turn right', 'go forward', 'pick up', 'drop', 'toggle']
+
+# JSON schemas passed to ollama's format option, keyed by a substring of the env id.
+# With one of these the model can only emit a single well-formed action and stops right after it.
+ACTION_SCHEMAS = {
+    'TowerOfHanoi-v0': {'type': 'object',
+                        'properties': {'from': {'type': 'string', 'enum': ['A', 'B', 'C']},
+                                       'to': {'type': 'string', 'enum': ['A', 'B', 'C']}},
+                        'required': ['from', 'to']},
+    'RushHour-v0': {'type': 'object',
+                    'properties': {'car': {'type': 'string', 'pattern': '^[A-Z]$'},
+                                   'direction': {'type': 'string', 'enum': ['+', '-']}},
+                    'required': ['car', 'direction']},
+    'BabyAI-': {'type': 'object',
+                'properties': {'action': {'type': 'string', 'enum': BABYAI_ACTIONS}},
+                'required': ['action']},
+}
+
+# short instruction to append to prompts so the text matches what the schema will enforce
+SCHEMA_HINTS = {
+    'TowerOfHanoi-v0': 'Answer only with JSON of the form {"from": "A", "to": "C"}.',
+    'RushHour-v0': 'Answer only with JSON of the form {"car": "A", "direction": "+"}.',
+    'BabyAI-': 'Answer only with JSON of the form {"action": "go forward"}.',
+}
+
+def get_action_schema(env_id):
+    for key in ACTION_SCHEMAS:
+        if key in env_id:
+            return ACTION_SCHEMAS[key]
+    return None
+
+def get_schema_hint(env_id):
+    for key in SCHEMA_HINTS:
+        if key in env_id:
+            return SCHEMA_HINTS[key]
+    return ""
+
+def parse_structured_action(text, env_id):
+    """
+    Turns a schema constrained response into the action string the env expects, or -1 if the
+    text is not a complete JSON action (e.g. the model was not constrained or is still decoding).
+    """
+    try:
+        action = json.loads(text)
+    except ValueError:
+        return -1
+    if not isinstance(action, dict):
+        return -1
+
+    if "TowerOfHanoi-v0" in env_id and 'from' in action and 'to' in action:
+        return f"[{action['from']} {action['to']}]"
+    elif "RushHour-v0" in env_id and 'car' in action and 'direction' in action:
+        return f"[{action['car']}{action['direction']}]"
+    elif "BabyAI-" in env_id and action.get('action') in BABYAI_ACTIONS:
+        return action['action']
+    return -1
@@ -1,35 +1,535 @@
-import ollama
+import asyncio
+import math
+import random
+import time
+from llm_backends import OllamaBackend, to_dict
+from context_window import context_window_for
 
 class AgentLLM:
-    def __init__(self, model_name, context_size, temperature, max_tokens):
+    def __init__(self, model_name, context_size, temperature, max_tokens, backend=None, keep_alive=-1):
         super().__init__()
         self.model_name = model_name
+        self.backend = backend if backend is not None else OllamaBackend() # any llm_backends.LLMBackend
+        self.keep_alive = keep_alive # how long the server keeps the model loaded after a call, -1 = forever
         self.options = {'num_ctx': context_size, # max number of tokens allowed in context
                         'temperature': temperature, # sampling temperature
                         'num_predict': max_tokens # max number of decoded tokens before interrupt
                         } 
     
     def get_action(self, prompt):
-        return ollama.generate(model=self.model_name,
+        return self.backend.generate(model=self.model_name,
                         prompt=prompt,
-                        options=self.options)
+                        options=self.options,
+                        keep_alive=self.keep_alive)
 
 class ContextAgentLLM:
-    def __init__(self, model_name, context_size, temperature, max_tokens):
+    def __init__(self, model_name, context_size, temperature, max_tokens, prefix_cache=None, response_cache=None,
+                 backend=None, output_format=None, telemetry=None, keep_alive=-1):
         super().__init__()
         self.model_name = model_name
+        self.backend = backend if backend is not None else OllamaBackend() # any llm_backends.LLMBackend
+        # keep_alive is a request field, not a model option (ollama ignores it inside options), -1 = forever
+        self.keep_alive = keep_alive
+        self.prefix_cache = prefix_cache # optional llm_cache.PrefixCache shared across episodes
+        self.response_cache = response_cache # optional llm_cache.ResponseCache, only used when temperature is 0
+        self.output_format = output_format # ollama format: "json" or a JSON schema, see action_formats.get_action_schema
+        self.telemetry = telemetry # optional telemetry.LLMTelemetry recording every call
         self.options = {'num_ctx': context_size, # max number of tokens allowed in context
                         'temperature': temperature, # sampling temperature
-                        'num_predict': max_tokens, # max number of decoded tokens before interrupt
-                        'keep_alive': -1
+                        'num_predict': max_tokens # max number of decoded tokens before interrupt
                         } 
     
-    def get_action(self, prompt, context, num_predict=None):
+    def get_action(self, prompt, context, num_predict=None, stop_parser=None, tags=None, logprobs=False):
+        """
+        If stop_parser is given the response is streamed and decoding stops as soon as
+        stop_parser(text_so_far) returns something other than -1, i.e. once an action can be parsed, as long as
+        more of num_predict is left than the replay that recovers the context would decode (see stop_pays_off).
+        tags (e.g. {'episode': 3, 'step': 7}) are attached to the telemetry record of the call.
+        logprobs=True asks for the log probability of every decoded token (non-streamed calls only).
+        """
+        start = time.perf_counter()
+        options_to_pass = self.build_options(num_predict, stream=stop_parser is not None)
+
+        key, response = self.lookup_response(prompt, context, options_to_pass)
+        if response is None:
+            request = self.make_request(prompt, context, options_to_pass, session_of(tags), logprobs)
+            if stop_parser is None:
+                response = self.backend.generate(**request)
+            else:
+                text, n_tokens, final = "", 0, None
+                stream = self.backend.generate_stream(**request)
+                for chunk in stream:
+                    text += chunk['response']
+                    n_tokens += 1
+                    if chunk['done']:
+                        final = chunk
+                        break
+                    if self.stop_pays_off(options_to_pass, n_tokens) and stop_parser(text) != -1:
+                        break
+                # closing the stream drops the connection, which stops decoding on the server
+                stream.close()
+                if final is None:
+                    replay_start = time.perf_counter()
+                    response = self.backend.generate(**self.replay_request(request, n_tokens))
+                    self.record_call(response, replay_start, dict(tags or {}, phase='replay'))
+                response = self.finish_stream(text, n_tokens, final, response)
+            self.store_response(key, response)
+        self.record_call(response, start, tags)
+        return response
+
+    def record_call(self, response, start, tags=None):
+        if self.telemetry is not None:
+            if response.get('early_stop'):
+                # the counts are the replay's, which has its own record; the stream only tells how much it decoded
+                response = {'eval_count': response['streamed_tokens'], 'cached': response.get('cached', False)}
+            self.telemetry.record(response, time.perf_counter() - start, model=self.model_name, **(tags or {}))
+
+    def make_request(self, prompt, context, options, session=None, logprobs=False):
+        request = dict(model=self.model_name,
+                       prompt=prompt,
+                       options=options,
+                       context=context,
+                       keep_alive=self.keep_alive,
+                       session=session)
+        if logprobs:
+            request['logprobs'] = True
+        if self.output_format is not None:
+            # constrained decoding: the server only lets the model emit text matching the format
+            request['format'] = self.output_format
+        return request
+
+    def build_options(self, num_predict=None, stream=False):
         options_to_pass = self.options.copy()
         if num_predict is not None:
             options_to_pass['num_predict'] = num_predict
+        if stream and options_to_pass['temperature'] != 0 and 'seed' not in options_to_pass:
+            # pin the sampling seed so a cut-off stream can be replayed exactly, see replay_request
+            options_to_pass['seed'] = random.randrange(2**31)
+        return options_to_pass
 
-        return ollama.generate(model=self.model_name,
-                        prompt=prompt,
-                        options=options_to_pass,
-                        context=context)
\ No newline at end of file
+    def stop_pays_off(self, options, n_tokens):
+        # cutting the stream after n_tokens means decoding them again in replay_request, which only saves
+        # time if more than that is left of the budget
+        num_predict = options.get('num_predict')
+        return num_predict is None or num_predict < 0 or num_predict - n_tokens > n_tokens
+
+    def replay_request(self, request, n_tokens):
+        # ollama only sends the context with the final chunk, so a stream stopped early has none.
+        # Re-running the same request (same seed) for just the tokens already seen gets it back; the prompt
+        # is still in the server's KV cache, so this costs n_tokens of decoding instead of up to max_tokens.
+        replay = dict(request)
+        replay['options'] = dict(request['options'], num_predict=n_tokens)
+        return replay
+
+    def finish_stream(self, text, n_tokens, final, replayed):
+        if final is not None:
+            response = to_dict(final)
+            response['response'] = text
+            return response
+        response = to_dict(replayed)
+        response['early_stop'] = True
+        response['streamed_tokens'] = n_tokens
+        return response
+
+    def lookup_response(self, prompt, context, options):
+        # sampled responses are not reproducible, so only greedy decoding is memoized
+        if self.response_cache is None or options['temperature'] != 0:
+            return None, None
+        if self.output_format is not None:
+            options = dict(options, format=self.output_format)
+        key = self.response_cache.make_key(self.model_name, options, prompt, context)
+        response = self.response_cache.get(key)
+        if response is not None:
+            response['cached'] = True
+        return key, response
+
+    def store_response(self, key, response):
+        if key is not None:
+            self.response_cache.put(key, response)
+
+    def warmup(self, prefix=None):
+        """
+        Loads the model on the server (and evaluates prefix, if given) before the first episode,
+        so the load time is paid and reported once instead of landing on the first step.
+        Returns the load time in seconds.
+        """
+        start = time.perf_counter()
+        # a request without a prompt only loads the model
+        response = self.backend.generate(model=self.model_name, prompt="", keep_alive=self.keep_alive)
+        self.record_call(response, start, {'phase': 'load'})
+        if prefix is not None:
+            self.get_prefix_context(prefix)
+        return self.report_load(response, start)
+
+    def report_load(self, response, start):
+        load_seconds = (response.get('load_duration') or 0) / 1e9
+        print(f"Model {self.model_name} ready after {time.perf_counter() - start:.2f}s (load {load_seconds:.2f}s)")
+        return load_seconds
+
+    def close(self, unload=False):
+        """
+        Releases the connection pool. With unload=True the server also drops the model right away
+        instead of keeping it for keep_alive.
+        """
+        if unload:
+            self.backend.generate(model=self.model_name, prompt="", keep_alive=0)
+        self.backend.close()
+
+    def get_prefix_context(self, prefix):
+        """
+        Evaluates a static prompt prefix (e.g. rules + replay buffer) without decoding and returns
+        its context, so each episode can start from it instead of re-sending the prefix text.
+        """
+        key, context = self.lookup_prefix(prefix)
+        if context is None:
+            context = self.get_action(prefix, context=[], num_predict=0, tags={'phase': 'prefix'})['context']
+            self.store_prefix(key, context)
+        return context
+
+    def lookup_prefix(self, prefix):
+        if self.prefix_cache is None:
+            return None, None
+        key = self.prefix_cache.make_key(self.model_name, self.options, prefix)
+        return key, self.prefix_cache.get(key)
+
+    def store_prefix(self, key, context):
+        if self.prefix_cache is not None:
+            self.prefix_cache.put(key, context)
+
+    def score_actions(self, prompt, context, candidates, top_logprobs=20, tags=None):
+        """
+        Picks the candidate action with the highest log-likelihood as an answer to prompt instead of
+        free generating, so the answer is always one of the candidates. All candidates are scored from
+        the top logprobs of a single short decoded answer (see action_scoring_steps).
+        Returns a response dict whose 'response' is the chosen candidate, plus the per-candidate
+        'action_scores'. Its 'context' ends with the decoded answer if that is the chosen candidate,
+        otherwise with the prompt.
+        """
+        start = time.perf_counter()
+        steps = self.action_scoring_steps(prompt, context, candidates, top_logprobs, session_of(tags))
+        response = self.run_steps(steps)
+        self.record_call(response, start, tags)
+        return response
+
+    def run_steps(self, steps):
+        # drives a generator that yields backend requests and gets their responses sent back
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(to_dict(self.backend.generate(**request)))
+        except StopIteration as result:
+            return result.value
+
+    def scoring_request(self, prompt, context, num_predict, top_logprobs=None, session=None):
+        request = dict(model=self.model_name,
+                       prompt=prompt,
+                       options=self.build_options(num_predict),
+                       context=context,
+                       keep_alive=self.keep_alive,
+                       session=session)
+        if top_logprobs is not None:
+            request['logprobs'] = True
+            request['top_logprobs'] = top_logprobs
+        return request
+
+    def action_scoring_steps(self, prompt, context, candidates, top_logprobs, session=None):
+        # One templated call decodes a short answer with the top alternatives at every position. A candidate
+        # follows the decoded tokens while they match it; where it leaves them it is charged the matching
+        # alternative at that position (or the unlisted bound) and the rest of it is taken as given, since
+        # that prefix already tells it apart from the candidates still on the decoded path.
+        # Raw continuations would be cheaper to aim, but ollama ignores the context of raw calls.
+        answer_tokens = 2 * max(len(candidate.split()) for candidate in candidates) + 1
+        response = yield self.scoring_request(prompt, context, answer_tokens, top_logprobs, session=session)
+        positions = response.get('logprobs') or []
+
+        scores, on_path = {}, {}
+        for candidate in candidates:
+            text, total, followed = "", 0.0, True
+            for position in positions:
+                rest = candidate[len(text):].lower()
+                if rest == "":
+                    break
+                # the answer usually starts with a space or a capital letter, neither matters here
+                normalize = (lambda token: token.lstrip().lower()) if text == "" else (lambda token: token.lower())
+                decoded = normalize(position['token'])
+                if decoded and rest.startswith(decoded):
+                    total += position['logprob']
+                    text += candidate[len(text):len(text) + len(decoded)]
+                    continue
+                followed = False
+                alternatives = [(t['token'], t['logprob']) for t in position.get('top_logprobs') or []]
+                matches = [logprob for token, logprob in alternatives if normalize(token) and rest.startswith(normalize(token))]
+                total += max(matches) if matches else unlisted_logprob(alternatives)
+                break
+            if text == "" and len(positions) == 0:
+                total = float('-inf')
+            scores[candidate] = total
+            on_path[candidate] = followed
+
+        best = max(candidates, key=lambda c: scores[c])
+        context = response['context']
+        if not on_path[best]:
+            # the decoded answer was not the one picked, so it is dropped from the context; the runners
+            # show the chosen action in the next observation anyway
+            context = context[:len(context) - (response.get('eval_count') or 0)]
+
+        response = dict(response, response=best, context=context, action_scores=scores, scoring_calls=1)
+        response.pop('logprobs', None)
+        return response
+
+def session_of(tags):
+    # calls of one episode share a session, so a routing backend keeps them on the server holding their context
+    return (tags or {}).get('episode')
+
+def unlisted_logprob(tokens):
+    # a token missing from the top list is no likelier than the least likely listed one, nor than the leftover mass
+    if len(tokens) == 0:
+        return float('-inf')
+    probs = [math.exp(logprob) for _, logprob in tokens]
+    return math.log(min(min(probs), max(1.0 - sum(probs), 1e-12)))
+
+class AsyncContextAgentLLM(ContextAgentLLM):
+    """
+    asyncio version of ContextAgentLLM with the same get_action(prompt, context) contract.
+    All calls go through the backend's pooled async client, so many episodes can have a request
+    in flight at once. max_in_flight bounds the number of concurrent requests to the server.
+    """
+    def __init__(self, model_name, context_size, temperature, max_tokens, host=None, max_in_flight=8,
+                 prefix_cache=None, response_cache=None, backend=None, output_format=None, telemetry=None, keep_alive=-1):
+        if backend is None:
+            backend = OllamaBackend(host=host, max_connections=max_in_flight)
+        super().__init__(model_name, context_size, temperature, max_tokens, prefix_cache, response_cache, backend,
+                         output_format, telemetry, keep_alive)
+        self.max_in_flight = max_in_flight
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def get_action(self, prompt, context, num_predict=None, stop_parser=None, tags=None, logprobs=False):
+        start = time.perf_counter()
+        options_to_pass = self.build_options(num_predict, stream=stop_parser is not None)
+
+        key, response = self.lookup_response(prompt, context, options_to_pass)
+        if response is None:
+            request = self.make_request(prompt, context, options_to_pass, session_of(tags), logprobs)
+            async with self.semaphore:
+                if stop_parser is None:
+                    response = await self.backend.agenerate(**request)
+                else:
+                    text, n_tokens, final = "", 0, None
+                    stream = await self.backend.agenerate_stream(**request)
+                    async for chunk in stream:
+                        text += chunk['response']
+                        n_tokens += 1
+                        if chunk['done']:
+                            final = chunk
+                            break
+                        if self.stop_pays_off(options_to_pass, n_tokens) and stop_parser(text) != -1:
+                            break
+                    await stream.aclose()
+                    if final is None:
+                        replay_start = time.perf_counter()
+                        response = await self.backend.agenerate(**self.replay_request(request, n_tokens))
+                        self.record_call(response, replay_start, dict(tags or {}, phase='replay'))
+                    response = self.finish_stream(text, n_tokens, final, response)
+            self.store_response(key, response)
+        self.record_call(response, start, tags)
+        return response
+
+    async def warmup(self, prefix=None):
+        start = time.perf_counter()
+        response = await self.backend.agenerate(model=self.model_name, prompt="", keep_alive=self.keep_alive)
+        self.record_call(response, start, {'phase': 'load'})
+        if prefix is not None:
+            await self.get_prefix_context(prefix)
+        return self.report_load(response, start)
+
+    async def close(self, unload=False):
+        if unload:
+            await self.backend.agenerate(model=self.model_name, prompt="", keep_alive=0)
+        await self.backend.aclose()
+
+    async def get_prefix_context(self, prefix):
+        key, context = self.lookup_prefix(prefix)
+        if context is None:
+            context = (await self.get_action(prefix, context=[], num_predict=0, tags={'phase': 'prefix'}))['context']
+            self.store_prefix(key, context)
+        return context
+
+    async def score_actions(self, prompt, context, candidates, top_logprobs=20, tags=None):
+        start = time.perf_counter()
+        steps = self.action_scoring_steps(prompt, context, candidates, top_logprobs, session_of(tags))
+        response = await self.run_steps(steps)
+        self.record_call(response, start, tags)
+        return response
+
+    async def run_steps(self, steps):
+        try:
+            request = next(steps)
+            while True:
+                async with self.semaphore:
+                    response = await self.backend.agenerate(**request)
+                request = steps.send(to_dict(response))
+        except StopIteration as result:
+            return result.value
+
+def answer_confidence(response):
+    # geometric mean of the token probabilities of the answer, None if the server sent no logprobs
+    logprobs = response.get('logprobs') or []
+    if len(logprobs) == 0:
+        return None
+    return math.exp(sum(t['logprob'] for t in logprobs) / len(logprobs))
+
+class CascadeAgentLLM:
+    """
+    Answers every step with the cheapest of several ContextAgentLLM tiers (smallest model first) that gives
+    an acceptable answer. A tier's answer is passed over, and the step escalated to the next tier, when
+    parser(text) returns -1, when validator(action, prompt) is False, or when the mean token probability of
+    the answer is below min_confidence. The last tier's answer is always used.
+    The caller keeps the first tier's context; when another tier's answer was used, the first tier's next prompt says so.
+    Larger tiers skip the easy steps, so each keeps its own context per session (tags['episode']) and the
+    steps it missed are sent as text in front of the next prompt that reaches it.
+    Every step is logged in steps with the tier that answered, why lower tiers were passed over and the
+    tokens spent, see summary().
+    """
+    def __init__(self, tiers, parser, validator=None, min_confidence=0.5, keep_last=8):
+        self.tiers = tiers
+        self.parser = parser # text -> action or -1, e.g. a stop_parser
+        self.validator = validator # optional (action, prompt) -> bool, e.g. a legality check on the board in prompt
+        self.min_confidence = min_confidence # None to ignore confidence
+        self.keep_last = keep_last # turns kept when a larger tier's own context has to be compacted
+        self.prefix = None
+        self.sessions = {} # session -> {tier: {'window': ContextWindow or None, 'backlog': [turn text]}}
+        self.steps = []
+
+    @property
+    def model_name(self):
+        return self.tiers[0].model_name
+
+    @property
+    def options(self):
+        # the caller's context belongs to the first tier, so its window has to follow the first tier's limits
+        return self.tiers[0].options
+
+    def warmup(self, prefix=None):
+        # every tier may be needed on the first step, so all of them are loaded up front
+        for agent in self.tiers:
+            agent.warmup()
+        if prefix is not None:
+            self.get_prefix_context(prefix)
+
+    def close(self, unload=False):
+        closed = []
+        for agent in self.tiers:
+            if unload:
+                agent.backend.generate(model=agent.model_name, prompt="", keep_alive=0)
+            if agent.backend not in closed:
+                agent.backend.close()
+                closed.append(agent.backend)
+
+    def get_prefix_context(self, prefix):
+        # larger tiers evaluate the prefix the first time a session escalates to them
+        self.prefix = prefix
+        return self.tiers[0].get_prefix_context(prefix)
+
+    def tier_state(self, session, tier):
+        state = self.sessions.setdefault(session, {})
+        if tier not in state:
+            state[tier] = {'window': None, 'backlog': []}
+        return state[tier]
+
+    def tier_context(self, state, tier):
+        if state['window'] is None:
+            agent = self.tiers[tier]
+            if self.prefix is not None:
+                state['window'] = context_window_for(agent, self.keep_last, agent.get_prefix_context(self.prefix))
+            else:
+                # without a prefix the rules come with the first prompt, which is the first turn of the backlog
+                state['window'] = context_window_for(agent, self.keep_last, pin_first_turns=1)
+        return state['window'].context
+
+    def rejection(self, response, prompt):
+        action = self.parser(response['response'])
+        if action == -1:
+            return 'parse'
+        if self.validator is not None and not self.validator(action, prompt):
+            return 'invalid'
+        confidence = answer_confidence(response)
+        if self.min_confidence is not None and confidence is not None and confidence < self.min_confidence:
+            return 'confidence'
+        return None
+
+    def get_action(self, prompt, context, stop_parser=None, tags=None):
+        """
+        Same contract as ContextAgentLLM.get_action. stop_parser only applies to the last tier, the
+        others are not streamed because their logprobs are needed for the confidence check.
+        """
+        session = session_of(tags)
+        responses, rejected = [], []
+        for tier, agent in enumerate(self.tiers):
+            tier_tags = dict(tags or {}, tier=tier)
+            if tier == 0:
+                # the caller's context is the first tier's, only a note about a replaced answer is pending
+                state = self.tier_state(session, 0)
+                tier_prompt, tier_context = "".join(state['backlog']) + prompt, context
+                state['backlog'] = []
+            else:
+                state = self.tier_state(session, tier)
+                tier_context = self.tier_context(state, tier)
+                tier_prompt = "".join(state['backlog']) + prompt
+            if tier == len(self.tiers) - 1:
+                responses.append(to_dict(agent.get_action(tier_prompt, tier_context, stop_parser=stop_parser, tags=tier_tags)))
+                break
+            responses.append(to_dict(agent.get_action(tier_prompt, tier_context, tags=tier_tags, logprobs=True)))
+            reason = self.rejection(responses[-1], prompt)
+            if reason is None:
+                break
+            rejected.append({'tier': tier, 'model': agent.model_name, 'reason': reason})
+
+        chosen = len(responses) - 1
+        response = responses[chosen]
+        turn = f"{prompt}\nAnswer: {response['response']}\n"
+        for tier in range(1, len(self.tiers)):
+            state = self.tier_state(session, tier)
+            if tier == chosen:
+                state['window'].update(response['context'])
+                state['backlog'] = []
+            else:
+                # a tier that was skipped, or whose answer was not used, hears about this step next time
+                state['backlog'].append(turn)
+        if chosen > 0:
+            # the caller keeps the first tier's context, which ends with the answer that was not used; ollama
+            # cannot rewrite it in place (raw calls return no context), so the next prompt says what was used
+            response = dict(response, context=responses[0]['context'])
+            self.tier_state(session, 0)['backlog'] = [f"(The answer used for the last step was: {response['response']})\n"]
+
+        self.steps.append({'session': session,
+                           'step': (tags or {}).get('step'),
+                           'tier': chosen,
+                           'model': self.tiers[chosen].model_name,
+                           'rejected': rejected,
+                           'tokens': [(r.get('prompt_eval_count') or 0) + (r.get('eval_count') or 0) for r in responses]})
+        response['tier'] = chosen
+        response['escalations'] = rejected
+        return response
+
+    def summary(self):
+        answered = [0] * len(self.tiers)
+        tokens = [0] * len(self.tiers)
+        reasons = {}
+        for step in self.steps:
+            answered[step['tier']] += 1
+            for tier, n in enumerate(step['tokens']):
+                tokens[tier] += n
+            for r in step['rejected']:
+                reasons[r['reason']] = reasons.get(r['reason'], 0) + 1
+        return {'steps': len(self.steps),
+                'answered_by': {agent.model_name: n for agent, n in zip(self.tiers, answered)},
+                'tokens_by': {agent.model_name: n for agent, n in zip(self.tiers, tokens)},
+                'escalation_reasons': reasons,
+                'first_tier_rate': answered[0] / len(self.steps) if self.steps else 0.0}
+
+    def print_summary(self):
+        s = self.summary()
+        print(f"Cascade: {s['steps']} steps, {s['first_tier_rate']:.0%} answered by {self.tiers[0].model_name}")
+        for model in s['answered_by']:
+            print(f"  {model}: answered {s['answered_by'][model]} steps, {s['tokens_by'][model]} tokens")
+        print(f"  escalations: {s['escalation_reasons']}")
@@ -3,11 +3,32 @@ import re
 import ollama
 import json
 import os
+import math
 import random
+from concurrent.futures import ThreadPoolExecutor
+from llm_cache import hash_text
+from hanoi_metrics import replay_quality
+from replay_dedup import mmr_selection
 #from textarena_interaction import ContextAgentLLM
 
 
-def compare_replays(agent, replay_a, replay_b):
+def compare_replays(agent, replay_a, replay_b, preference_cache=None):
+    """
+    Returns '1' or '2' for the replay the agent would rather keep. With a llm_cache.PreferenceCache,
+    a pair already judged in this order is answered from the cache instead of the model.
+    """
+    key = None
+    if preference_cache is not None:
+        key = preference_cache.make_key(agent.model_name, replay_a, replay_b)
+        winner = preference_cache.get(key)
+        if winner is not None:
+            return winner
+    winner = judge_replays(agent, replay_a, replay_b)
+    if key is not None:
+        preference_cache.put(key, winner)
+    return winner
+
+def judge_replays(agent, replay_a, replay_b):
     game = "Tower of Hanoi"
 
     prompt = f"""
@@ -33,10 +54,51 @@ Output strictly "1" or "2" indicating which replay you would prefer to keep.
         return '2'
     return '1'
 
-def get_LLM_selection(agent, buff_list, num_to_select):
+def pair_survivors(survivors, n_matches, judged=()):
+    """
+    Picks n_matches disjoint pairs from survivors (already shuffled). Pairs in judged, a set of
+    (hash shown first, hash shown second), are taken first and in that order; the rest are paired by position.
+    Returns the pairs and the survivors left without a match.
+    """
+    keys = [hash_text(replay) for replay in survivors]
+    partners = {} # hash -> (other hash, whether this one was shown first)
+    for key_a, key_b in sorted(judged):
+        partners.setdefault(key_a, []).append((key_b, True))
+        partners.setdefault(key_b, []).append((key_a, False))
+    positions = {}
+    for i, key in enumerate(keys):
+        positions.setdefault(key, []).append(i)
+
+    pairs, matched = [], set()
+    for i, key in enumerate(keys):
+        if len(pairs) == n_matches:
+            break
+        if i in matched:
+            continue
+        for other, first in partners.get(key, []):
+            j = next((j for j in positions.get(other, []) if j != i and j not in matched), None)
+            if j is not None:
+                pairs.append((survivors[i], survivors[j]) if first else (survivors[j], survivors[i]))
+                matched.update([i, j])
+                break
+    rest = [i for i in range(len(survivors)) if i not in matched]
+    n_new = min(n_matches - len(pairs), len(rest) // 2)
+    pairs += [(survivors[rest[2 * k]], survivors[rest[2 * k + 1]]) for k in range(n_new)]
+    return pairs, [survivors[i] for i in rest[2 * n_new:]]
+
+def get_LLM_selection(agent, buff_list, num_to_select, max_workers=4, seed=None, preference_cache=None):
     """
     Reduces the buffer to num_to_select items using pairwise tournament selection.
+    Every round shuffles the survivors, pairs them up and keeps the winner of each pair, with only as
+    many matches as are needed to reach num_to_select. The matches of a round are independent, so they
+    are sent to the model from max_workers threads at once (the server needs OLLAMA_NUM_PARALLEL > 1 to
+    actually run them side by side). Pairings only depend on seed and the replays, never on which answer
+    comes back first.
+    Judgements are memoized in preference_cache (llm_cache.PreferenceCache) if given, which is saved at the end.
+    Pairs it already holds are matched up first each round, so a tournament over a grown buffer replays the
+    old brackets from the cache and only the new replays (and whoever they meet) go to the model.
     """
+    rng = random.Random(seed)
     # Working copy of the buffer
     survivors = buff_list[:]
     
@@ -46,67 +108,269 @@ def get_LLM_selection(agent, buff_list, num_to_select):
 
     print(f"Starting tournament: Reducing {len(survivors)} items to {num_to_select}...")
 
-    while len(survivors) > num_to_select:
-        next_round = []
-        
-        # Shuffle to prevent positional bias
-        random.shuffle(survivors)
-        
-        # We need to calculate how many items we MUST eliminate this round
-        # to avoid over-reducing if num_to_select is high.
-        # However, a simple approach is: pair up as many as possible.
-        # If we have 10 and want 5: 5 pairs -> 5 winners.
-        # If we have 10 and want 8: This logic is tricky with pure knockout.
-        
-        # ROBUST APPROACH: 
-        # Iterate through the list. Compare [i] vs [i+1]. 
-        # Loser gets deleted immediately.
-        # Stop deleting once we reach num_to_select.
-        
-        i = 0
-        while i < len(survivors) - 1:
-            # Check if we have already reached the target size
-            if len(survivors) == num_to_select:
-                break
-                
-            replay_a = survivors[i]
-            replay_b = survivors[i+1]
-            
-            # Ask agent for preference
-            winner = compare_replays(agent, replay_a, replay_b)
-            
-            if winner == '1':
-                # Keep 1 (at index i), remove 2 (at index i+1)
-                survivors.pop(i+1)
-            else:
-                # Keep 1, remove 2 (at index i)
-                survivors.pop(i)
-                
-            # Move to next distinct pair (since we popped one, 'i' now points to a new item, 
-            # but we want to move past the winner to give others a chance)
-            i += 1 
-            
-        # If we loop through everyone and still have too many, the while loop runs again.
-        
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(survivors) > num_to_select:
+            # Shuffle to prevent positional bias. Ordering by a salted hash of the content instead of rng.shuffle
+            # keeps the order of the old replays when one is added.
+            salt = rng.random()
+            survivors.sort(key=lambda replay: hash_text(f"{salt}:{replay}"))
+
+            # Pair up the judged pairs, then [0] vs [1], [2] vs [3], ... of the rest, but stop eliminating once we
+            # would reach the target size. If we have 10 and want 5: 5 matches -> 5 winners. If we have 10 and want 8:
+            # 2 matches this round.
+            n_matches = min(len(survivors) // 2, len(survivors) - num_to_select)
+            judged = preference_cache.judged_pairs(agent.model_name) if preference_cache is not None else ()
+            pairs, unmatched = pair_survivors(survivors, n_matches, judged)
+            winners = list(executor.map(lambda pair: compare_replays(agent, *pair, preference_cache), pairs))
+
+            next_round = [a if winner == '1' else b for (a, b), winner in zip(pairs, winners)]
+            # items without a match this round go through untouched
+            survivors = next_round + unmatched
+
+    if preference_cache is not None:
+        preference_cache.save()
+        print(f"Preference cache: {preference_cache.hits} hits, {preference_cache.misses} misses")
     return survivors
 
 
-def buffer_selection(buff_list, method, num_to_select=3, agent=None):
+class ReplayRatings:
+    """
+    Persistent Elo rating of every replay, keyed by a hash of its text, updated after each comparison.
+    Pairs that were already judged are remembered so the same evidence is never counted twice.
+    If path is given, the ratings are loaded from that json file and save() writes them back.
+    """
+    def __init__(self, path=None, k_factor=32, initial_rating=1500.0):
+        self.path = path
+        self.k_factor = k_factor
+        self.initial_rating = initial_rating
+        self.ratings = {} # replay hash -> [rating, games played]
+        self.played = set() # 'hash_a:hash_b' with the hashes sorted
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def rating(self, replay):
+        return self.key_rating(hash_text(replay))
+
+    def key_rating(self, key):
+        # same as rating, for a replay whose hash is already known
+        return self.ratings.get(key, [self.initial_rating, 0])
+
+    def pair_key(self, replay_a, replay_b):
+        return ":".join(sorted([hash_text(replay_a), hash_text(replay_b)]))
+
+    def has_played(self, replay_a, replay_b):
+        return self.pair_key(replay_a, replay_b) in self.played
+
+    def keys_played(self, key_a, key_b):
+        return ":".join(sorted([key_a, key_b])) in self.played
+
+    def update(self, winner, loser):
+        (r_w, n_w), (r_l, n_l) = self.rating(winner), self.rating(loser)
+        delta = self.k_factor * (1 - expected_score(r_w, r_l))
+        self.ratings[hash_text(winner)] = [r_w + delta, n_w + 1]
+        self.ratings[hash_text(loser)] = [r_l - delta, n_l + 1]
+        self.played.add(self.pair_key(winner, loser))
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            stored = json.load(fp)
+        self.ratings = stored['ratings']
+        self.played = set(stored['played'])
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, 'w') as fp:
+            json.dump({'ratings': self.ratings, 'played': sorted(self.played)}, fp)
+
+def expected_score(rating_a, rating_b):
+    # probability that a beats b under the Elo model
+    return 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+
+def pick_informative_pairs(replays, ratings, num_to_select, n_pairs, keys=None, max_candidates=2000, window=64,
+                           few_games=2):
+    """
+    Picks up to n_pairs disjoint, not yet played pairs whose outcome is most likely to change the top
+    num_to_select: evenly matched pairs (p close to 0.5) of replays with few games, near the top of the ranking.
+    Only the top max_candidates replays and those with fewer than few_games games are paired, each with the
+    window replays ranked just below it (the evenly matched ones), so a round costs O(n * window), not O(n^2).
+    keys are the hashes of replays, if the caller already has them.
+    """
+    if keys is None:
+        keys = [hash_text(replay) for replay in replays]
+    stats = [ratings.key_rating(key) for key in keys]
+    order = sorted(range(len(replays)), key=lambda i: stats[i][0], reverse=True)
+    candidates = [i for rank, i in enumerate(order) if rank < max_candidates or stats[i][1] < few_games]
+
+    scored = []
+    for a in range(len(candidates)):
+        i = candidates[a]
+        r_i, n_i = stats[i]
+        # below the top 2 * num_to_select a comparison rarely changes which replays get selected
+        weight = 1.0 if a < 2 * num_to_select else 0.25
+        for b in range(a + 1, min(a + 1 + window, len(candidates))):
+            j = candidates[b]
+            if ratings.keys_played(keys[i], keys[j]):
+                continue
+            r_j, n_j = stats[j]
+            p = expected_score(r_i, r_j)
+            uncertainty = 1 / math.sqrt(1 + n_i) + 1 / math.sqrt(1 + n_j)
+            scored.append((p * (1 - p) * uncertainty * weight, a, b))
+    scored.sort(key=lambda entry: entry[0], reverse=True)
+
+    pairs, used = [], set()
+    for _, a, b in scored:
+        if a in used or b in used:
+            continue
+        pairs.append((replays[candidates[a]], replays[candidates[b]]))
+        used.update([a, b])
+        if len(pairs) == n_pairs:
+            break
+    return pairs
+
+def get_rated_selection(agent, buff_list, num_to_select, ratings, budget=8, max_workers=4, seed=None, preference_cache=None):
+    """
+    Returns the num_to_select replays with the highest ReplayRatings rating after at most budget new
+    comparisons, so the cost of selection per episode is fixed in advance whatever the buffer size.
+    Comparisons go in rounds of up to max_workers informative pairs (see pick_informative_pairs), each
+    shown in an order drawn from seed to even out positional bias. Ratings persist across episodes,
+    so replays that were already ranked only need comparisons against the new ones.
+    """
+    rng = random.Random(seed)
+    # identical replays share a rating, comparing them would tell us nothing; each replay is hashed once
+    unique = {hash_text(replay): replay for replay in buff_list}
+    keys, replays = list(unique), list(unique.values())
+    if len(buff_list) <= num_to_select:
+        return buff_list[:]
+
+    n_compared = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while n_compared < budget:
+            pairs = pick_informative_pairs(replays, ratings, num_to_select, min(max_workers, budget - n_compared), keys)
+            if len(pairs) == 0:
+                break
+            shown = [(a, b) if rng.random() < 0.5 else (b, a) for a, b in pairs]
+            winners = list(executor.map(lambda pair: compare_replays(agent, *pair, preference_cache), shown))
+            for (a, b), winner in zip(shown, winners):
+                if winner == '1':
+                    ratings.update(a, b)
+                else:
+                    ratings.update(b, a)
+            n_compared += len(pairs)
+
+    ratings.save()
+    if preference_cache is not None:
+        preference_cache.save()
+    print(f"Rated selection: {n_compared} comparisons (budget {budget})")
+    ranked = sorted(range(len(replays)), key=lambda i: ratings.key_rating(keys[i])[0], reverse=True)
+    return [replays[i] for i in ranked[:num_to_select]]
+
+
+class ReplayScores:
+    """
+    Quality scores of replays computed once, when the replay is added, by score_fn (replay -> dict with
+    a 'score' entry, e.g. hanoi_metrics.replay_quality), keyed by a hash of the replay text.
+    If path is given, the scores are loaded from that json file; add() saves them, other callers that
+    score many replays at once call save() when they are done.
+    """
+    def __init__(self, path=None, score_fn=replay_quality):
+        self.path = path
+        self.score_fn = score_fn
+        self.scores = {}
+        self.unsaved = 0 # scores computed since the last save
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def add(self, replay, save=True):
+        key = hash_text(replay)
+        if key not in self.scores:
+            self.scores[key] = self.score_fn(replay)
+            self.unsaved += 1
+            if save:
+                self.save()
+        return self.scores[key]
+
+    def score(self, replay):
+        # replays stored before the scores existed are scored on first use
+        return self.add(replay, save=False)['score']
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            self.scores = json.load(fp)
+
+    def save(self):
+        if self.path is None or self.unsaved == 0:
+            return
+        # written to a temporary file first, so a crash never leaves a half written file behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(self.scores, fp)
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+
+def buffer_selection(buff_list, method, num_to_select=3, agent=None, max_workers=4, seed=None, preference_cache=None,
+                     ratings=None, budget=8, index=None, query=None, scores=None, minhash=None, mmr_trade_off=0.5,
+                     mmr_pool=3, sampler=None):
+    """
+    With a replay_dedup.MinHashIndex as minhash, the random, recent and LLM methods first pick mmr_pool times
+    more candidates than needed and then keep num_to_select of them by maximal marginal relevance, so
+    near-duplicate trajectories do not fill the buffer.
+    """
+    diverse = minhash is not None and method in ['random', 'recent', 'LLM']
+    n_candidates = min(len(buff_list), mmr_pool * num_to_select) if diverse else num_to_select
     if method == 'random':
         if len(buff_list) < num_to_select:
             return buff_list
-        prev_experiences = random.sample(buff_list, num_to_select)
+        prev_experiences = random.sample(buff_list, n_candidates)
     elif method == 'recent':
-        prev_experiences = buff_list[-num_to_select:]
+        prev_experiences = buff_list[-n_candidates:]
+        if diverse:
+            # most recent first, so recency is the relevance
+            prev_experiences = prev_experiences[::-1]
     elif method == 'LLM':
         if agent == None:
             print("NO AGENT PASSED")
             return -1
         else:
-            prev_experiences = get_LLM_selection(agent, buff_list, num_to_select)
+            prev_experiences = get_LLM_selection(agent, buff_list, n_candidates, max_workers, seed, preference_cache)
+    elif method == 'elo':
+        if agent == None:
+            print("NO AGENT PASSED")
+            return -1
+        if ratings is None:
+            ratings = ReplayRatings()
+        prev_experiences = get_rated_selection(agent, buff_list, num_to_select, ratings, budget, max_workers, seed,
+                                               preference_cache)
+    elif method == 'progress':
+        # best precomputed quality first, the most recent replay wins ties
+        if scores is None:
+            scores = ReplayScores()
+        ranked = sorted(range(len(buff_list)), key=lambda i: (scores.score(buff_list[i]), i), reverse=True)
+        scores.save()
+        prev_experiences = [buff_list[i] for i in ranked[:num_to_select]]
+    elif method == 'prioritized':
+        # weighted draw without replacement from a prioritized_replay.PrioritizedSampler
+        if sampler == None:
+            print("NO SAMPLER PASSED")
+            return -1
+        prev_experiences = sampler.sample(buff_list, num_to_select, random.Random(seed) if seed is not None else random)
+    elif method == 'similar':
+        # nearest neighbours of query (e.g. the mission or the initial board) in a replay_index.ReplayIndex
+        if index == None or query == None:
+            print("NO INDEX OR QUERY PASSED")
+            return -1
+        if len(buff_list) == 0:
+            return []
+        prev_experiences = index.search(query, buff_list, num_to_select)
     else:
         print("Improper Method selected")
         return -1
+    if diverse:
+        prev_experiences = mmr_selection(prev_experiences, num_to_select, minhash, mmr_trade_off)
+        if method == 'recent':
+            # back to the order they were played in
+            position = {id(replay): i for i, replay in enumerate(buff_list)}
+            prev_experiences = sorted(prev_experiences, key=lambda replay: position[id(replay)])
     return prev_experiences
 
 # if __name__ == "__main__":
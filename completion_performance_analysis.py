@@ -1,9 +1,9 @@
 import json
-import re
 
 import numpy as np
 from scipy.stats import chi2_contingency
 from scipy import stats
+from episode_record import episode_outcome
 
 def get_performance_trials(runs):
     perf_dict = {'solved': 0,
@@ -13,42 +13,36 @@ def get_performance_trials(runs):
                  '0%': 0, 
                  'failure': 0}
     for run in runs:
-        run = run.strip()
-                        
-        # 1. Find all punctuation indices (. ! ?)
-        # We use finditer to get the exact positions of punctuation
-        punct_matches = list(re.finditer(r'[.!?]', run))
-
-        last_sentence = ""
-        # Logic: If we have at least 2 punctuation marks, grab everything 
-        # after the second-to-last one.
-        if len(punct_matches) >= 2:
-            # Get the end index of the second-to-last punctuation mark
-            split_index = punct_matches[-2].end()
-            last_sentence = run[split_index:].strip()
-        elif len(punct_matches) == 1:
-            # If there is only one sentence, take the whole thing
-            last_sentence = run.strip()
-        else:
-            # Fallback if no punctuation is found
-            last_sentence = run.strip()[-100:]
+        # termination reason of a recorded episode, last sentence of an older transcript
+        last_sentence = episode_outcome(run)
         #print(last_sentence)
-        if 'solution' in last_sentence or 'solved' in last_sentence:
-            perf_dict['solved'] += 1
-        elif ' 0%' in last_sentence:
-            perf_dict['0%'] += 1
-        elif '25%' in last_sentence:
-            perf_dict['25%'] += 1
-        elif '50%' in last_sentence:
-            perf_dict['50%'] += 1
-        elif '75%' in last_sentence:
-            perf_dict['75%'] += 1
-        else: 
-            perf_dict['failure'] += 1
+        perf_dict[outcome_category(last_sentence)] += 1
         #print(perf_dict)
 
     return perf_dict
 
+def get_performance_records(records):
+    """
+    Same as get_performance_trials, for the episode records of an experience store (see load_episode_records).
+    """
+    perf_dict = {'solved': 0, '25%': 0, '50%': 0, '75%': 0, '0%': 0, 'failure': 0}
+    for record in records:
+        perf_dict[outcome_category(record['termination'])] += 1
+    return perf_dict
+
+def outcome_category(last_sentence):
+    if 'solution' in last_sentence or 'solved' in last_sentence:
+        return 'solved'
+    elif ' 0%' in last_sentence:
+        return '0%'
+    elif '25%' in last_sentence:
+        return '25%'
+    elif '50%' in last_sentence:
+        return '50%'
+    elif '75%' in last_sentence:
+        return '75%'
+    return 'failure'
+
 def make_perf_list(dict):
     perf_list = []
     for k in dict:
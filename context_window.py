@@ -0,0 +1,80 @@
+class ContextWindow:
+    """
+    Keeps the ollama context of one episode under a token budget.
+    Each context returned by the server is the context we sent plus one new turn (prompt + answer),
+    so turns can be told apart by length alone. Once the context grows past the budget, the oldest
+    turns are dropped, down to compact_to * budget tokens, while the pinned prelude (rules + replays)
+    and the last keep_last turns are kept. If those alone are still over budget, older kept turns are
+    dropped too (the most recent one always stays), since going past num_ctx would make the server
+    truncate from the front and lose the prelude instead.
+    """
+    def __init__(self, budget, keep_last=8, pinned=None, pin_first_turns=0, compact_to=0.75):
+        self.budget = budget
+        self.keep_last = keep_last
+        self.pinned = list(pinned or []) # prelude tokens that are never dropped
+        self.pin_first_turns = pin_first_turns # e.g. 1 when the prelude is sent with the first observation
+        self.compact_to = compact_to # compacting below the budget avoids re-evaluating a changed context every step
+        self.turns = []
+        self.turn_tokens = [] # tokens added by every turn, including dropped ones
+        self.n_compactions = 0
+        self.n_dropped_turns = 0
+        self.n_dropped_tokens = 0
+
+    @property
+    def context(self):
+        return self.pinned + [token for turn in self.turns for token in turn]
+
+    def __len__(self):
+        return len(self.pinned) + sum(len(turn) for turn in self.turns)
+
+    def update(self, new_context):
+        """
+        Records the context returned by the last call and returns the context to send with the next one.
+        """
+        current = self.context
+        new_context = list(new_context)
+        if new_context[:len(current)] != current:
+            # the server did not just extend what we sent (e.g. it truncated at num_ctx), so take its context as is
+            if new_context[:len(self.pinned)] != self.pinned:
+                self.pinned = []
+            self.turns = [new_context[len(self.pinned):]]
+            self.turn_tokens.append(len(new_context) - len(current))
+        else:
+            new_turn = new_context[len(current):]
+            self.turn_tokens.append(len(new_turn))
+            if len(self.turn_tokens) <= self.pin_first_turns:
+                self.pinned += new_turn
+            else:
+                self.turns.append(new_turn)
+
+        if len(self) > self.budget:
+            self.compact()
+        return self.context
+
+    def compact(self):
+        target = int(self.budget * self.compact_to)
+        # first drop turns older than the last keep_last, then whatever it takes to fit the budget
+        while len(self.turns) > self.keep_last and len(self) > target:
+            self.drop_oldest_turn()
+        while len(self.turns) > 1 and len(self) > self.budget:
+            self.drop_oldest_turn()
+        self.n_compactions += 1
+
+    def drop_oldest_turn(self):
+        dropped = self.turns.pop(0)
+        self.n_dropped_turns += 1
+        self.n_dropped_tokens += len(dropped)
+
+    def stats(self):
+        return {'context_tokens': len(self),
+                'pinned_tokens': len(self.pinned),
+                'turns_kept': len(self.turns),
+                'turn_tokens': self.turn_tokens,
+                'compactions': self.n_compactions,
+                'dropped_turns': self.n_dropped_turns,
+                'dropped_tokens': self.n_dropped_tokens}
+
+def context_window_for(agent, keep_last=8, pinned=None, pin_first_turns=0, headroom=1024):
+    # leave room under num_ctx for the answer and the next observation
+    budget = agent.options['num_ctx'] - agent.options['num_predict'] - headroom
+    return ContextWindow(budget, keep_last, pinned, pin_first_turns)
@@ -1,10 +1,20 @@
 import warnings
 warnings.filterwarnings("ignore") 
 from agent import ContextAgentLLM
+from action_formats import get_action_schema, get_schema_hint
+from context_window import context_window_for
+from telemetry import LLMTelemetry
+from llm_backends import OllamaBackend, ResilientBackend
+from llm_cache import PrefixCache
+from buffer_selection import buffer_selection
+from replay_index import ReplayIndex
+from experience_buffer import ExperienceBuffer
+from experience_store import ExperienceStore
+from episode_record import EpisodeText, BABYAI_OUTCOMES, babyai_action_request, new_episode_record, add_step, finish_episode
+from replay_encoding import encode_replay, encoding_report
 import ollama
 import gym
 import babyai_text
-import json
 import gym.utils.passive_env_checker as pec
 pec.logger.deprecation = lambda *args, **kwargs: None
 
@@ -20,7 +30,21 @@ if __name__ == "__main__":
     n_wins_per_task = 1 # number of wins after which we skip to the next task in the curriculum
     max_games_per_task = 10 # max number of attempts per task
     include_failed_runs = False # include failures in the replay buffer
+    buffer_capacity = None # most runs kept in the cache, None to keep every one
+    eviction_policy = 'fifo' # 'fifo', 'reservoir' or 'lrs' (least recently selected)
     cache_path = "caches/pickup_then_goto.json"
+    use_prefix_cache = True # reuse the evaluated rules + buffer context while the buffer is unchanged
+    prefix_cache_path = "caches/prefix_contexts.json"
+    n_similar_runs = None # None puts every stored run in the buffer, n keeps the n runs closest to the mission
+    replay_format = 'raw' # 'compact': replays go in the prompt as a step | observation | action table
+    embed_model = None # ollama embedding model for n_similar_runs (e.g. 'nomic-embed-text'), None for hashed n-grams
+    stream_actions = False # stop decoding once an action appears; actions are a few tokens, so the context replay rarely pays off
+    score_actions = False # pick the most likely of possible_actions by log-likelihood instead of generating
+    use_output_schema = False # constrain the model to a JSON action, format_action still finds it by substring
+    telemetry_path = "caches/curriculum_llm_calls.jsonl" # per call token counts and timings
+    call_timeout = 120 # seconds before a stalled call is abandoned and retried
+    max_retries = 3 # retries (with jittered exponential backoff) for timeouts and server errors
+    hedge_requests = False # duplicate calls slower than the recent p95 latency and keep the first answer
 
     # possible task choices are: ['goto', 'pickup', 'open', 'putnext', 'pick up seq go to']
     curriculum = [
@@ -33,16 +57,29 @@ if __name__ == "__main__":
     model_setting = {'model_name':'llama3.1:8b', 'context_size':7000, 'temperature':0, 'max_tokens':10}
     #model_setting = {'model_name':'gemma3:4b', 'context_size':8000, 'temperature':0, 'max_tokens':10}
 
-    agent = ContextAgentLLM(**model_setting)
     env_id = "BabyAI-MixedTrainLocal-v0"
+    telemetry = LLMTelemetry(telemetry_path, env=env_id)
+    agent = ContextAgentLLM(**model_setting, prefix_cache=PrefixCache(path=prefix_cache_path),
+                            output_format=get_action_schema(env_id) if use_output_schema else None,
+                            telemetry=telemetry,
+                            # the http timeout bounds every read, so a streamed step that stalls is cut off too
+                            backend=ResilientBackend(OllamaBackend(timeout=call_timeout), timeout=call_timeout,
+                                                     max_retries=max_retries, hedge=hedge_requests))
+    agent.warmup()
     possible_actions = ['turn left', 'turn right', 'go forward', 'pick up', 'drop', 'toggle']
+    stop_parser = (lambda text: format_action(text, possible_actions)) if stream_actions else None
+    # the constrained model is told the JSON it has to answer with (only in the prompt, stored runs keep the plain request)
+    schema_hint = get_schema_hint(env_id) if use_output_schema else ""
     
+    # every kept run is appended to the .jsonl store right away, the .json cache is a snapshot of it
+    experience_store = ExperienceStore(cache_path.replace('.json', '.jsonl'), legacy_path=cache_path)
     if clear_buffer_at_start:
-        with open(cache_path, 'w') as fp:
-            json.dump([], fp, indent=2)
+        experience_store.compact([])
+        experience_store.export([], cache_path)
 
-    with open(cache_path, 'r') as fp:
-        experience_cache = json.load(fp)
+    experience_cache = ExperienceBuffer(experience_store.load(), buffer_capacity, eviction_policy, store=experience_store)
+    # embeddings of the stored runs, next to the cache they belong to
+    replay_index = ReplayIndex(cache_path.replace('.json', '_index.npz'), embed_model)
 
     rules = "You are in a grid world containing balls and keys of different colours. There are walls that can block your movement. " + \
             "At every step, you will receive an observation about your local surroundings, and you will then select exactly one action " + \
@@ -58,12 +95,15 @@ if __name__ == "__main__":
         wins = 0
         games = 0
         env_params = curriculum[task]
+        telemetry.set_tags(stage=task, level=env_params['forced_level'])
         while wins < n_wins_per_task and games < max_games_per_task:
             # Create fresh environment for each episode
             env = gym.make(env_id, **env_params)
             obs, info = env.reset()
             counter = 0
             print(f"\n++++++++++++++++++ GAME {games+1} +++++++++++++++++++\n")
+            episode = f"{task}_{games}"
+            telemetry.set_tags(episode=episode)
 
             # Context for ollama (maintains conversation state)
             current_context = []
@@ -71,7 +111,19 @@ if __name__ == "__main__":
             prev_obs_len = 0
 
             # Prepare buffer text with past experiences (only for first turn)
-            selected_runs = [run for run in experience_cache]
+            if n_similar_runs is None:
+                selected_runs = [run for run in experience_cache]
+            else:
+                # the mission and first view describe what this game is about, retrieve the runs that look most like it
+                query = "Your mission is to " + obs['mission'] + "\n" + '. '.join(info['descriptions'])
+                selected_runs = buffer_selection(experience_cache, 'similar', n_similar_runs, index=replay_index, query=query)
+                experience_cache.mark_selected(selected_runs)
+            if replay_format == 'compact':
+                encoded_runs = [encode_replay(run, env_id) for run in selected_runs]
+                report = encoding_report(selected_runs, encoded_runs)
+                print(f"Compact replays: ~{report['raw_tokens']} -> ~{report['encoded_tokens']} tokens "
+                      f"({report['saved_fraction']:.0%} saved)")
+                selected_runs = encoded_runs
             buffer_text = ""
             if len(selected_runs) > 0:
                 buffer_text += "\nHere are some past attempts for you to draw experience from:\n"
@@ -80,25 +132,39 @@ if __name__ == "__main__":
                 buffer_text += "\nTry to learn from these experiences to explore options to solve the problem."
 
             print(f"Using {len(selected_runs)} past runs in buffer")
+            record = new_episode_record(env_id, env_params, agent, 'all' if n_similar_runs is None else 'similar',
+                                        len(selected_runs), mission=obs['mission'])
 
             prelude = rules + buffer_text + "\nThe game begins now. "
-            full_observation = prelude + "Your mission is to " + obs['mission'] + "\n" + '. '.join(info['descriptions']) + '.'
+            step_observation = '. '.join(info['descriptions']) + '.'
+            full_observation = prelude + "Your mission is to " + obs['mission'] + "\n" + step_observation
+            if use_prefix_cache:
+                # rules and buffer are already evaluated in the cached context, so only send what follows them
+                current_context = agent.get_prefix_context(prelude)
+                prev_obs_len = len(prelude)
+            # keeps the context under num_ctx by dropping old turns, never the rules + buffer prelude
+            window = context_window_for(agent, pinned=current_context, pin_first_turns=0 if use_prefix_cache else 1)
             for step in range(max_steps):
                 # Extract only the NEW part of the observation
                 new_observation = full_observation[prev_obs_len:]
-                observation_to_send = new_observation + "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is "
-                if step == 0:
+                observation_to_send = new_observation + babyai_action_request(obs['mission']) + schema_hint
+                if step == 0 and not use_prefix_cache:
                     print(observation_to_send[len(prelude):])
                 else:
                     print(observation_to_send)
 
                 # Update prev_obs_len for next iteration
                 prev_obs_len += len(observation_to_send)
-                full_observation += "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is "
+                full_observation += babyai_action_request(obs['mission']) + schema_hint
 
                 # Get action from agent
-                action_response = agent.get_action(observation_to_send, current_context)
-                current_context = action_response['context']
+                if score_actions:
+                    action_response = agent.score_actions(observation_to_send, current_context, possible_actions,
+                                                          tags={'episode': episode, 'step': step})
+                else:
+                    action_response = agent.get_action(observation_to_send, current_context,
+                                                       stop_parser=stop_parser, tags={'episode': episode, 'step': step})
+                current_context = window.update(action_response['context'])
 
                 # Format action for environment
                 formatted_action = format_action(action_response['response'], possible_actions)
@@ -107,6 +173,7 @@ if __name__ == "__main__":
                 else:     
                     action = possible_actions.index(formatted_action)
                     full_observation += formatted_action
+                    add_step(record, step_observation, formatted_action, action_response)
 
                 # Take step in environment
                 obs, r, done, info = env.step(action)
@@ -114,32 +181,34 @@ if __name__ == "__main__":
                 # check for success
                 if done:
                     print(formatted_action)
-                    print("Congratulations, you have accomplished your mission!")
-                    full_observation += "\nCongratulations, you have accomplished your mission!"
+                    print(BABYAI_OUTCOMES['success'])
+                    full_observation += "\n" + BABYAI_OUTCOMES['success']
                     wins += 1
                     break
                 
                 # if unsuccessful, append next observation and keep going
-                full_observation += "\n" + '. '.join(info['descriptions']) + '.'
+                step_observation = '. '.join(info['descriptions']) + '.'
+                full_observation += "\n" + step_observation
 
             if not done:
                 print(formatted_action)
-                print('The maximum number of steps has been reached, so you have failed!')
-                full_observation += "\n" + "The maximum number of steps has been reached, so you have failed!"
+                print(BABYAI_OUTCOMES['max_steps'])
+                full_observation += "\n" + BABYAI_OUTCOMES['max_steps']
 
-            full_episode_text = full_observation[len(prelude):]
             env.close()
             games += 1
-            if done:
-                header = "This was a successful run, so you probably took good actions.\n"
-                experience_cache.append(header + full_episode_text)
-            elif include_failed_runs:
-                header = "This was a failed run, so you probably took bad actions. Try to take better ones next time.\n"
-                experience_cache.append(header + full_episode_text)
+            # the stored run (success or failure header, then the game) is rendered from the record
+            finish_episode(record, r, 'success' if done else 'max_steps', "" if done else step_observation)
+            if done or include_failed_runs:
+                experience_cache.append(EpisodeText(record))
 
         if games == max_games_per_task and wins == 0:
             print(f'Did not succeed at all on task {task+1}. Exiting early.')
             break
     # Save updated cache
-    with open(cache_path, 'w') as fp:
-        json.dump(experience_cache, fp, indent=2)
+    experience_store.export(experience_cache, cache_path)
+    experience_store.close()
+    experience_cache.print_stats()
+    agent.close()
+    telemetry.print_summary()
+    telemetry.close()
\ No newline at end of file
@@ -0,0 +1,103 @@
+import re
+
+BABYAI_OUTCOMES = {'success': "Congratulations, you have accomplished your mission!",
+                   'max_steps': "The maximum number of steps has been reached, so you have failed!"}
+BABYAI_HEADERS = {'success': "This was a successful run, so you probably took good actions.\n",
+                  'max_steps': "This was a failed run, so you probably took bad actions. Try to take better ones next time.\n"}
+
+def babyai_action_request(mission):
+    return "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " \
+           + mission + ". Please respond with only the action. Your selected output action is "
+
+def new_episode_record(env_id, env_params, agent, buffer_method, n_buffered, seed=None, **fields):
+    """
+    Everything about one episode, filled in by the runner as it plays (see add_step and finish_episode)
+    so analysis never has to parse transcripts. The transcript stored in the experience cache is
+    rendered from it by episode_text. Any other fields (e.g. the BabyAI mission) are stored as given.
+    """
+    record = {'env_id': env_id,
+              'env_params': dict(env_params),
+              'seed': seed,
+              'model': {'model_name': agent.model_name, 'options': dict(agent.options)},
+              'buffer_method': buffer_method,
+              'n_buffered': n_buffered, # replays shown in the prompt
+              'steps': [],
+              'reward': None,
+              'termination': None,
+              'prompt_tokens': 0,
+              'completion_tokens': 0}
+    record.update(fields)
+    return record
+
+def add_step(record, observation, action, response, **fields):
+    """
+    observation is the environment text of this step as it appears in the transcript (without the replays
+    or instructions added to the prompt), action the formatted action and response the agent's response dict.
+    Any other fields (e.g. board, distance) are stored with the step.
+    """
+    step = {'observation': observation,
+            'action': action,
+            'response': response['response'],
+            'prompt_tokens': response.get('prompt_eval_count') or 0,
+            'completion_tokens': response.get('eval_count') or 0}
+    step.update(fields)
+    record['steps'].append(step)
+    record['prompt_tokens'] += step['prompt_tokens']
+    record['completion_tokens'] += step['completion_tokens']
+    return step
+
+def finish_episode(record, reward, termination, final_observation="", **fields):
+    # final_observation is the environment text that came after the last action
+    record['reward'] = reward
+    record['termination'] = termination
+    record['final_observation'] = final_observation
+    record.update(fields)
+    return record
+
+def textarena_text(record):
+    # textarena observations already show every move, so the transcript is the observations and the reason it ended
+    return "".join(step['observation'] for step in record['steps']) + record['final_observation'] + "\n" + record['termination']
+
+def babyai_text(record):
+    mission = record['mission']
+    text = BABYAI_HEADERS[record['termination']] + "Your mission is to " + mission + "\n"
+    for i, step in enumerate(record['steps']):
+        text += ("\n" if i > 0 else "") + step['observation'] + babyai_action_request(mission) + step['action']
+    if record['final_observation']:
+        text += "\n" + record['final_observation']
+    return text + "\n" + BABYAI_OUTCOMES[record['termination']]
+
+def episode_outcome(replay):
+    """
+    How an episode ended: the termination reason of an EpisodeText, or for a plain transcript its last
+    sentence (everything after the second to last . ! or ?).
+    """
+    if isinstance(replay, EpisodeText):
+        return replay.record['termination']
+    run = replay.strip()
+    punct_matches = list(re.finditer(r'[.!?]', run))
+    if len(punct_matches) >= 2:
+        return run[punct_matches[-2].end():].strip()
+    elif len(punct_matches) == 1:
+        return run
+    # no punctuation at all, the last 100 characters will have to do
+    return run[-100:]
+
+def episode_text(record):
+    """
+    The transcript of an episode, as the runners used to store it. Every env other than BabyAI-Text
+    (Tower of Hanoi, Rush Hour, ...) comes from textarena.
+    """
+    if "BabyAI-" in record['env_id']:
+        return babyai_text(record)
+    return textarena_text(record)
+
+class EpisodeText(str):
+    """
+    Transcript of an episode that carries its record, so it can go anywhere a replay string goes
+    (selection, indexes, prompts) while the experience store persists the record itself.
+    """
+    def __new__(cls, record):
+        text = super().__new__(cls, episode_text(record))
+        text.record = record
+        return text
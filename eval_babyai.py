@@ -1,7 +1,14 @@
 '''use this script to run a model with an already saved buffer and compute any statistics'''
 import warnings
 warnings.filterwarnings("ignore") 
-from agent import ContextAgentLLM
+from agent import AsyncContextAgentLLM
+from action_formats import get_action_schema, get_schema_hint
+from context_window import context_window_for
+from telemetry import LLMTelemetry
+from replay_encoding import encode_babyai_replay, encoding_report
+from llm_cache import PrefixCache, ResponseCache
+from llm_backends import OllamaBackend, ScriptedBackend, RoutingBackend, ResilientBackend, babyai_rule_responder
+import asyncio
 import ollama
 import gym
 import babyai_text
@@ -15,6 +22,99 @@ def format_action(response, possible_actions):
             return a
     return -1
 
+async def run_episode(agent, env_id, env_params, seed, prelude, possible_actions, max_steps, episode, prelude_context=None,
+                      stream_actions=False, score_actions=False):
+    # Create fresh environment for each episode
+    env = gym.make(env_id, seed=seed, **env_params)
+    obs, info = env.reset()
+    # Episodes run concurrently, so collect the printout and emit it in one piece at the end
+    log = [f"\n++++++++++++++++++NEW GAME {episode+1}+++++++++++++++++++\n"]
+
+    # stop decoding as soon as one of the possible actions appears in the response
+    stop_parser = (lambda text: format_action(text, possible_actions)) if stream_actions else None
+    # a schema constrained agent is told the JSON it has to answer with
+    schema_hint = get_schema_hint(env_id) if agent.output_format is not None else ""
+
+    # Context for ollama (maintains conversation state)
+    current_context = []
+    # Track how much of the observation we've already processed
+    prev_obs_len = 0
+    if prelude_context is not None:
+        # rules and buffer are already evaluated in the cached prefix context, so only send what follows them
+        current_context = list(prelude_context)
+        prev_obs_len = len(prelude)
+    # keeps the context under num_ctx by dropping old turns, never the rules + buffer prelude
+    window = context_window_for(agent, pinned=prelude_context, pin_first_turns=0 if prelude_context is not None else 1)
+
+    full_observation = prelude + "Your mission is to " + obs['mission'] + "\n" + '. '.join(info['descriptions']) + '.'
+    for step in range(max_steps):
+        # Extract only the NEW part of the observation
+        new_observation = full_observation[prev_obs_len:]
+        observation_to_send = new_observation + "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is: " + schema_hint
+        if step == 0 and prelude_context is None:
+            log.append(observation_to_send[len(prelude):])
+        else:
+            log.append(observation_to_send)
+
+        # Update prev_obs_len for next iteration
+        prev_obs_len += len(observation_to_send)
+        full_observation += "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is: " + schema_hint
+
+        # Get action from agent, other episodes keep stepping while this request is in flight
+        if score_actions:
+            action_response = await agent.score_actions(observation_to_send, current_context, possible_actions,
+                                                        tags={'episode': episode, 'step': step})
+        else:
+            action_response = await agent.get_action(observation_to_send, current_context,
+                                                     stop_parser=stop_parser, tags={'episode': episode, 'step': step})
+        current_context = window.update(action_response['context'])
+
+        # Format action for environment
+        formatted_action = format_action(action_response['response'], possible_actions)
+        if formatted_action == -1:
+            raise Exception(f'invalid action selection: {action_response["response"]}')
+        else:     
+            action = possible_actions.index(formatted_action)
+            full_observation += formatted_action
+
+        # Take step in environment
+        obs, r, done, info = env.step(action)
+        
+        # check for success
+        if done:
+            log.append(formatted_action)
+            log.append("Congratulations, you have accomplished your mission!")
+            full_observation += "\nCongratulations, you have accomplished your mission!"
+            break
+        
+        # if unsuccessful, append next observation and keep going
+        full_observation += "\n" + '. '.join(info['descriptions']) + '.'
+
+    if not done:
+        log.append(formatted_action)
+        log.append('The maximum number of steps has been reached, so you have failed!')
+        full_observation += "\n" + "The maximum number of steps has been reached, so you have failed!"
+
+    env.close()
+    print("\n".join(log))
+    return done
+
+async def run_all_episodes(agent, env_id, env_params, seeds, prelude, possible_actions, max_steps, use_prefix_cache=True,
+                           stream_actions=False, score_actions=False):
+    # load the model before the first episode so its load time is not counted as step latency
+    await agent.warmup()
+    # pretokenize the rules and buffer only once so they can immediately be passed as context at every episode
+    prelude_context = None
+    if use_prefix_cache:
+        prelude_context = await agent.get_prefix_context(prelude)
+    episodes = [run_episode(agent, env_id, env_params, seeds[episode], prelude, possible_actions, max_steps, episode, prelude_context,
+                            stream_actions, score_actions)
+                for episode in range(len(seeds))]
+    try:
+        return await asyncio.gather(*episodes)
+    finally:
+        await agent.close()
+
 if __name__ == "__main__":
     use_buffer = True
     # possible task choices are: ['goto', 'pickup', 'open', 'putnext', 'pick up seq go to']
@@ -25,6 +125,20 @@ if __name__ == "__main__":
     #seeds = [16]
     model_setting = {'model_name':'llama3.1:8b', 'context_size':7000, 'temperature':0, 'max_tokens':10}
     #model_setting = {'model_name':'gemma3:4b', 'context_size':10000, 'temperature':0, 'max_tokens':10}
+    max_in_flight = 8 # number of episodes allowed to wait on the model server at the same time
+    use_prefix_cache = True # evaluate rules + buffer once and start every episode from the cached context
+    prefix_cache_path = "caches/prefix_contexts.json"
+    response_cache_path = "caches/responses.sqlite" # memoized temperature=0 responses, set to None to always query the model
+    stream_actions = False # stop decoding once an action appears; actions are a few tokens, so the context replay rarely pays off
+    score_actions = False # pick the most likely of possible_actions by log-likelihood instead of generating
+    use_output_schema = False # constrain the model to a JSON action, format_action still finds it by substring
+    offline = False # answer with a rule-based policy instead of a model server (harness benchmarks, CI)
+    ollama_hosts = None # e.g. ["http://gpu1:11434", "http://gpu2:11434"], episodes stick to one server each
+    call_timeout = 120 # seconds before a stalled call is abandoned and retried
+    max_retries = 3 # retries (with jittered exponential backoff) for timeouts and server errors
+    hedge_requests = False # duplicate calls slower than the recent p95 latency and keep the first answer
+    telemetry_path = "caches/babyai_llm_calls.jsonl" # per call token counts and timings
+    replay_format = 'raw' # 'compact': replays go in the prompt as a step | observation | action table
 
     buffer_text = ""
     if use_buffer: # Prepare buffer text with past experiences
@@ -33,14 +147,34 @@ if __name__ == "__main__":
         with open(cache_path, 'r') as fp:
             experience_cache = json.load(fp)
         selected_runs = experience_cache[:]
+        if replay_format == 'compact':
+            encoded_runs = [encode_babyai_replay(run) for run in selected_runs]
+            report = encoding_report(selected_runs, encoded_runs)
+            print(f"Compact replays: ~{report['raw_tokens']} -> ~{report['encoded_tokens']} tokens "
+                  f"({report['saved_fraction']:.0%} saved)")
+            selected_runs = encoded_runs
         buffer_text += "\nHere are some past attempts for you to draw experience from:\n"
         for i in range(len(selected_runs)):
             buffer_text +=  f"<run {i+1}>\n" + selected_runs[i] + f"\n<run {i+1}>\n"
         buffer_text += "\nTry to learn from these experiences to explore options to solve the problem."
         #buffer_text += "These experiences were for the individual pick up and go to tasks, but you will now need to compose the skills you have learned above in order to solve the new task, which requires you to first pick up an object and then go to another object. "
 
-    agent = ContextAgentLLM(**model_setting)
+    response_cache = ResponseCache(response_cache_path) if response_cache_path is not None else None
+    if offline:
+        backend = ScriptedBackend(babyai_rule_responder)
+    elif ollama_hosts is not None:
+        backend = RoutingBackend(ollama_hosts, max_connections=max_in_flight, timeout=call_timeout)
+    else:
+        backend = OllamaBackend(max_connections=max_in_flight, timeout=call_timeout)
+    backend = ResilientBackend(backend, timeout=call_timeout, max_retries=max_retries, hedge=hedge_requests)
     env_id = "BabyAI-MixedTrainLocal-v0"
+    telemetry = LLMTelemetry(telemetry_path, env=env_id, level=env_params['forced_level'])
+    agent = AsyncContextAgentLLM(**model_setting, max_in_flight=max_in_flight,
+                                 prefix_cache=PrefixCache(path=prefix_cache_path),
+                                 response_cache=response_cache,
+                                 backend=backend,
+                                 output_format=get_action_schema(env_id) if use_output_schema else None,
+                                 telemetry=telemetry)
     possible_actions = ['turn left', 'turn right', 'go forward', 'pick up', 'drop', 'toggle']
     
     rules = "You are in a grid world containing balls and keys of different colours. There are walls that can block your movement. " + \
@@ -51,9 +185,6 @@ if __name__ == "__main__":
             "If you need to pick up an object, the object must be one step in front of you before you can use the pick up action successfully. "
 
     prelude = rules + buffer_text + "\nThe game begins now. "
-    # pretokenize the rules and buffer only once so they can immediately be passed as context at every episod
-    # res = agent.get_action(prompt=prelude, context=[], num_predict=0)
-    # prelude_context = res['context']
 
     print(f'Task parameters: {env_params}')
     print(rules + "\n")
@@ -61,64 +192,10 @@ if __name__ == "__main__":
         print(f"Using {len(selected_runs)} past runs in buffer")
         print(buffer_text)
 
-    wins = 0
-    for episode in range(n_eps):
-        # Create fresh environment for each episode
-        env = gym.make(env_id, seed=seeds[episode], **env_params)
-        obs, info = env.reset()
-        counter = 0
-        print(f"\n++++++++++++++++++NEW GAME {episode+1}+++++++++++++++++++\n")
-
-        # Context for ollama (maintains conversation state)
-        current_context = []
-        # Track how much of the observation we've already processed
-        prev_obs_len = 0
-
-        full_observation = prelude + "Your mission is to " + obs['mission'] + "\n" + '. '.join(info['descriptions']) + '.'
-        for step in range(max_steps):
-            # Extract only the NEW part of the observation
-            new_observation = full_observation[prev_obs_len:]
-            observation_to_send = new_observation + "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is: "
-            if step == 0:
-                print(observation_to_send[len(prelude):])
-            else:
-                print(observation_to_send)
-
-            # Update prev_obs_len for next iteration
-            prev_obs_len += len(observation_to_send)
-            full_observation += "\nNow select one of the following options: turn left, turn right, go forward, pick up. Remember, you are trying to find and " + obs['mission'] + ". Please respond with only the action. Your selected output action is: "
-
-            # Get action from agent
-            action_response = agent.get_action(observation_to_send, current_context)
-            current_context = action_response['context']
-
-            # Format action for environment
-            formatted_action = format_action(action_response['response'], possible_actions)
-            if formatted_action == -1:
-                raise Exception(f'invalid action selection: {action_response["response"]}')
-            else:     
-                action = possible_actions.index(formatted_action)
-                full_observation += formatted_action
-
-            # Take step in environment
-            obs, r, done, info = env.step(action)
-            
-            # check for success
-            if done:
-                print(formatted_action)
-                print("Congratulations, you have accomplished your mission!")
-                full_observation += "\nCongratulations, you have accomplished your mission!"
-                wins += 1
-                break
-            
-            # if unsuccessful, append next observation and keep going
-            full_observation += "\n" + '. '.join(info['descriptions']) + '.'
-
-        if not done:
-            print(formatted_action)
-            print('The maximum number of steps has been reached, so you have failed!')
-            full_observation += "\n" + "The maximum number of steps has been reached, so you have failed!"
-
-        env.close()
-
-    print(f'\nThe agent won {wins}/{n_eps} games')
\ No newline at end of file
+    results = asyncio.run(run_all_episodes(agent, env_id, env_params, seeds, prelude, possible_actions, max_steps, use_prefix_cache,
+                                           stream_actions, score_actions))
+    wins = sum(results)
+
+    print(f'\nThe agent won {wins}/{n_eps} games')
+    telemetry.print_summary()
+    telemetry.close()
\ No newline at end of file
@@ -0,0 +1,121 @@
+import random
+import time
+from collections import Counter
+from llm_cache import hash_text
+
+EVICTION_POLICIES = ['fifo', 'reservoir', 'lrs', 'quality']
+
+class ExperienceBuffer(list):
+    """
+    List of replays that never holds more than capacity of them (None = unbounded). Once full, append()
+    evicts according to policy:
+        'fifo': the oldest replay,
+        'reservoir': keeps a uniform sample of every replay ever appended (reservoir sampling), so the
+                     new replay itself may be the one dropped,
+        'lrs': the least recently selected replay (see mark_selected), new replays count as just selected,
+        'quality': the replay with the lowest score_fn(replay), e.g. buffer_selection.ReplayScores.score.
+    The kept replays stay in the order they were played. Every eviction is recorded in evictions,
+    stats() summarizes them.
+    If store (an experience_store.ExperienceStore) is given, every kept replay and every eviction is
+    written to it as it happens.
+    """
+    def __init__(self, replays=(), capacity=None, policy='fifo', score_fn=None, seed=None, store=None):
+        super().__init__()
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"unknown eviction policy {policy}, expected one of {EVICTION_POLICIES}")
+        if policy == 'quality' and score_fn is None:
+            raise ValueError("the quality eviction policy needs a score_fn")
+        self.capacity = capacity
+        self.policy = policy
+        self.score_fn = score_fn
+        self.rng = random.Random(seed)
+        self.n_seen = 0 # replays ever appended, the loaded ones included
+        self.clock = 0 # counts selections, for 'lrs'
+        self.last_selected = {} # replay hash -> clock at its last selection
+        self.evictions = []
+        self.store = None
+        for replay in replays:
+            self.append(replay)
+        if store is not None and store.n_seen is not None:
+            # replays offered in earlier runs count too, or reservoir sampling would favour every new run
+            self.n_seen = max(self.n_seen, store.n_seen)
+        if store is not None and (store.needs_compact or len(self.evictions) > 0):
+            # a legacy cache, a smaller capacity than last time or too many evictions in the log
+            store.compact(self, self.n_seen)
+        self.store = store
+
+    def append(self, replay):
+        """
+        Adds replay, evicting one if the buffer is full. Returns False if replay itself was not kept.
+        """
+        self.n_seen += 1
+        self.last_selected.setdefault(hash_text(replay), self.clock)
+        if self.capacity is None or len(self) < self.capacity:
+            super().append(replay)
+            if self.store is not None:
+                self.store.append(replay, self.n_seen)
+            return True
+
+        if self.policy == 'fifo':
+            victim, reason = 0, "oldest"
+        elif self.policy == 'reservoir':
+            # keep the new replay with probability capacity / n_seen, in place of a uniformly chosen one
+            j = self.rng.randrange(self.n_seen)
+            victim, reason = (j, "reservoir replacement") if j < self.capacity else (None, "reservoir rejection")
+        elif self.policy == 'lrs':
+            victim = min(range(len(self)), key=lambda i: (self.last_selected.get(hash_text(self[i]), 0), i))
+            reason = "least recently selected"
+        else:
+            scores = [self.score_fn(r) for r in self]
+            victim = min(range(len(self)), key=lambda i: (scores[i], i))
+            if self.score_fn(replay) <= scores[victim]:
+                victim = None
+            reason = "lowest quality"
+
+        if victim is None:
+            self.record_eviction(replay, reason, new=True)
+            if self.store is not None:
+                self.store.note_seen(self.n_seen)
+            return False
+        self.record_eviction(self[victim], reason)
+        if self.store is not None:
+            # new replay first, so a crash in between leaves one replay too many rather than one too few
+            self.store.append(replay, self.n_seen)
+            self.store.remove(self[victim])
+        del self[victim]
+        super().append(replay)
+        return True
+
+    def extend(self, replays):
+        for replay in replays:
+            self.append(replay)
+
+    def mark_selected(self, replays):
+        # call with the replays buffer_selection returned, so 'lrs' knows which ones are still in use
+        self.clock += 1
+        for replay in replays:
+            self.last_selected[hash_text(replay)] = self.clock
+
+    def record_eviction(self, replay, reason, new=False):
+        key = hash_text(replay)
+        self.evictions.append({'time': time.time(),
+                               'policy': self.policy,
+                               'reason': reason,
+                               'new_replay': new, # the replay being appended was the one dropped
+                               'hash': key,
+                               'last_selected': self.last_selected.pop(key, None),
+                               'score': self.score_fn(replay) if self.score_fn is not None else None,
+                               'start': replay[:80]})
+
+    def stats(self):
+        return {'capacity': self.capacity,
+                'size': len(self),
+                'seen': self.n_seen,
+                'evicted': len(self.evictions),
+                'new_replays_dropped': sum(e['new_replay'] for e in self.evictions),
+                'evicted_by_reason': dict(Counter(e['reason'] for e in self.evictions))}
+
+    def print_stats(self):
+        s = self.stats()
+        print(f"Experience buffer: {s['size']}/{s['capacity']} replays kept of {s['seen']} seen, "
+              f"{s['evicted']} evicted ({s['new_replays_dropped']} new ones not kept) {s['evicted_by_reason']}")
@@ -0,0 +1,125 @@
+import json
+import os
+from llm_cache import hash_text
+from episode_record import EpisodeText
+
+class ExperienceStore:
+    """
+    Append-only JSON lines file backing an experience cache, so adding a replay costs one line however
+    big the cache is, and a run killed mid-sweep loses at most the replay being written.
+    Every line is {"replay": text}, {"episode": record} for an episode_record.EpisodeText (loaded back as one,
+    its transcript rendered from the record), or {"evict": hash} when ExperienceBuffer drops a replay. Lines
+    may also carry "seen", how many replays were ever offered to the cache (for reservoir sampling). Each line is
+    flushed and fsynced before append() returns; a torn last line (crash while writing) is skipped on load.
+    If path does not exist yet, load() reads legacy_path (the old whole-file json list) instead; the
+    store file is only written once something is appended, so read-only users never create it.
+    """
+    def __init__(self, path, legacy_path=None, compact_ratio=2.0):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.compact_ratio = compact_ratio # rewrite the file once it has this many lines per kept replay
+        self.n_lines = 0
+        self.n_seen = None # replays ever offered, as of the last line that said so
+        self.needs_compact = False
+        self.fp = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            if self.legacy_path is not None and os.path.exists(self.legacy_path):
+                with open(self.legacy_path, 'r') as fp:
+                    replays = json.load(fp)
+                # written out as a fresh store on the first compact or append
+                self.needs_compact = True
+                return replays
+            return []
+
+        replays, hashes = [], []
+        self.n_lines = 0
+        with open(self.path, 'r') as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Skipping a torn record in {self.path}")
+                    continue
+                self.n_lines += 1
+                if 'seen' in record:
+                    self.n_seen = record['seen']
+                if 'replay' in record or 'episode' in record:
+                    replay = record['replay'] if 'replay' in record else EpisodeText(record['episode'])
+                    replays.append(replay)
+                    hashes.append(hash_text(replay))
+                elif 'evict' in record and record['evict'] in hashes:
+                    # identical copies are interchangeable, so the first one goes
+                    i = hashes.index(record['evict'])
+                    del replays[i], hashes[i]
+        if self.n_lines > self.compact_ratio * max(len(replays), 1):
+            self.needs_compact = True
+        return replays
+
+    def write(self, record):
+        if self.fp is None:
+            self.fp = open(self.path, 'a')
+            if self.fp.tell() > 0:
+                with open(self.path, 'rb') as fp:
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b"\n":
+                        # terminate a torn last line so the next record starts on its own line
+                        self.fp.write("\n")
+        self.fp.write(json.dumps(record) + "\n")
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.n_lines += 1
+
+    def append(self, replay, n_seen=None):
+        self.write(self.line(replay, n_seen))
+
+    def line(self, replay, n_seen=None):
+        line = {'episode': replay.record} if isinstance(replay, EpisodeText) else {'replay': replay}
+        if n_seen is not None:
+            line['seen'] = n_seen
+        return line
+
+    def note_seen(self, n_seen):
+        # a replay was offered but not kept, only the count changes
+        self.write({'seen': n_seen})
+
+    def remove(self, replay):
+        self.write({'evict': hash_text(replay)})
+
+    def compact(self, replays, n_seen=None):
+        """
+        Rewrites the store as just replays (a temporary file renamed over the old one, so a crash leaves
+        either the old or the new store).
+        """
+        self.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as fp:
+            if n_seen is not None:
+                fp.write(json.dumps({'seen': n_seen}) + "\n")
+            for replay in replays:
+                fp.write(json.dumps(self.line(replay)) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self.n_lines = len(replays) + (n_seen is not None)
+        self.n_seen = n_seen
+        self.needs_compact = False
+
+    def export(self, replays, json_path):
+        # whole-file json snapshot for the analysis scripts, written atomically like compact
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump(list(replays), fp, indent=2)
+        os.replace(tmp_path, json_path)
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+def load_episode_records(path):
+    """
+    The episode records kept in the experience store at path (replays stored as plain text are skipped).
+    """
+    return [replay.record for replay in ExperienceStore(path).load() if isinstance(replay, EpisodeText)]
@@ -0,0 +1,135 @@
+import re
+
+def extract_board_states(buffer_text):
+    """
+    Scans a raw text buffer and returns a list of board strings.
+    
+    Args:
+        buffer_text (str): The full raw text of the replay buffer.
+        
+    Returns:
+        list of str: A list where each element is a clean board string 
+                     ready for parsing.
+    """
+    # Regex Explanation:
+    # 1. \[GAME\] Current Board: \s* -> Matches the header and potential whitespace/newlines
+    # 2. (                            -> Start capturing group for the board content
+    # 3.   A: \[.*?\]\s* -> Matches 'A: [...]' and trailing whitespace
+    # 4.   B: \[.*?\]\s* -> Matches 'B: [...]' and trailing whitespace
+    # 5.   C: \[.*?\]                 -> Matches 'C: [...]'
+    # 6. )                            -> End capturing group
+    # Flags: DOTALL is not strictly needed if we explicitly match newlines, 
+    # but re.MULTILINE helps anchor ^ if needed. Here we keep it simple.
+    
+    pattern = r"\[GAME\] Current Board:\s*(A: \[.*?\]\s*B: \[.*?\]\s*C: \[.*?\])"
+    
+    # re.findall returns all non-overlapping matches in the string
+    matches = re.findall(pattern, buffer_text, re.DOTALL)
+    
+    # Clean up the matches to ensure they look exactly like your example
+    # (removing excess trailing newlines if regex caught them)
+    cleaned_states = [m.strip() for m in matches]
+    
+    return cleaned_states
+
+def parse_board_state(log_string):
+    """
+    Parses the game board string into a dictionary: {'A': [4,3], 'B': [2], 'C': [1]}
+    Assumes lists are ordered [bottom, ..., top] based on your example.
+    """
+    state = {'A': [], 'B': [], 'C': []}
+    
+    # Regex to find lines like "A: [4, 3, 2, 1]"
+    # Matches the letter, then captures the content inside brackets
+    matches = re.findall(r'([ABC]): \[([\d, \-]*)\]', log_string)
+    
+    for peg, content in matches:
+        if content.strip():
+            # Convert "4, 3, 2" string to list of ints [4, 3, 2]
+            # Filter out -1 if your logs sometimes use placeholders
+            disks = [int(x.strip()) for x in content.split(',') if x.strip()]
+            state[peg] = disks
+        else:
+            state[peg] = []
+            
+    return state
+
+def get_disk_location(state, disk_val):
+    for peg in ['A', 'B', 'C']:
+        if disk_val in state[peg]:
+            return peg
+    return None
+
+def calculate_hanoi_distance(state, n_disks=4, target_peg='C'):
+    """
+    Recursively calculates minimum moves to solve from current state.
+    """
+    # Base case
+    if n_disks == 0:
+        return 0
+    
+    # Find where the current largest disk (n) is
+    current_peg = get_disk_location(state, n_disks)
+    
+    # If the disk is missing (error in log parsing?), return error or infinity
+    if current_peg is None:
+        return float('inf') 
+
+    if current_peg == target_peg:
+        # Disk N is already in place. We just need to solve for N-1 on top of it.
+        # Target remains the same.
+        return calculate_hanoi_distance(state, n_disks - 1, target_peg)
+    else:
+        # Disk N is on the wrong peg.
+        # 1. We need to move disks 1..(N-1) to the AUX peg.
+        # 2. Move Disk N (1 move).
+        # 3. Move disks 1..(N-1) from AUX to Target (Known cost: 2^(N-1) - 1).
+        
+        # Determine Auxiliary peg (The one that isn't current or target)
+        pegs = {'A', 'B', 'C'}
+        aux_peg = list(pegs - {current_peg, target_peg})[0]
+        
+        # Recursive step: How many moves to get smaller stack to Aux?
+        moves_to_stack_aux = calculate_hanoi_distance(state, n_disks - 1, aux_peg)
+        
+        # Total = (moves to clear way) + (move disk N) + (move stack back)
+        # Simplified: moves_to_stack_aux + 2^(n-1)
+        return moves_to_stack_aux + (2 ** (n_disks - 1))
+
+def replay_quality(run, n_disks=4, target_peg='C'):
+    """
+    Scores a Hanoi replay from its board states alone, no model needed. Returns a dict with
+    final_distance (moves still needed at the end), progress (fraction of the starting distance covered),
+    monotonicity (fraction of moves that did not move away from the solution), optimal_fraction
+    (fraction of moves that were optimal, i.e. brought the distance down by exactly one), solved and
+    score, a 0 to 1 mix of the above used to rank replays.
+    """
+    distances = [calculate_hanoi_distance(parse_board_state(board), n_disks, target_peg)
+                 for board in extract_board_states(run)]
+    distances = [d for d in distances if d != float('inf')]
+    if len(distances) == 0:
+        return {'final_distance': None, 'progress': 0.0, 'monotonicity': 0.0, 'optimal_fraction': 0.0,
+                'solved': False, 'score': 0.0}
+
+    steps = list(zip(distances[:-1], distances[1:]))
+    max_distance = 2 ** n_disks - 1
+    quality = {'final_distance': distances[-1],
+               'progress': (distances[0] - distances[-1]) / distances[0] if distances[0] > 0 else 1.0,
+               'monotonicity': sum(after <= before for before, after in steps) / len(steps) if steps else 1.0,
+               'optimal_fraction': sum(after == before - 1 for before, after in steps) / len(steps) if steps else 1.0,
+               'solved': distances[-1] == 0}
+    # how close the run got matters most, how cleanly it got there breaks ties between similar endings
+    quality['score'] = 0.5 * (1 - distances[-1] / max_distance) \
+                       + 0.25 * quality['monotonicity'] + 0.25 * quality['optimal_fraction']
+    return quality
+
+def board_distance(text, n_disks=4, target_peg='C'):
+    """
+    The last board shown in text and its distance to the solution, or (None, None) if text shows no board.
+    """
+    boards = extract_board_states(text)
+    if len(boards) == 0:
+        return None, None
+    state = parse_board_state(boards[-1])
+    distance = calculate_hanoi_distance(state, n_disks, target_peg)
+    return state, distance if distance != float('inf') else None
@@ -1,27 +1,23 @@
 import textarena as ta
-from agent import AgentLLM
+from agent import ContextAgentLLM, CascadeAgentLLM
+from llm_backends import OllamaBackend, ScriptedBackend, RoutingBackend, ResilientBackend, hanoi_oracle_responder
 import re
-import ollama
-import json
 import os
-from buffer_selection import buffer_selection
+from buffer_selection import buffer_selection, ReplayRatings, ReplayScores
+from hanoi_metrics import replay_quality, board_distance
+from replay_dedup import MinHashIndex
+from prioritized_replay import PrioritizedSampler
+from experience_buffer import ExperienceBuffer
+from experience_store import ExperienceStore
+from replay_store import ReplayStore
+from episode_record import EpisodeText, new_episode_record, add_step, finish_episode, episode_outcome
+from replay_encoding import encode_replay, encoding_report
 import re
-from optimal_agent import get_best_move
-class ContextAgentLLM:
-    def __init__(self, model_name, context_size, temperature, max_tokens):
-        super().__init__()
-        self.model_name = model_name
-        self.options = {'num_ctx': context_size, # max number of tokens allowed in context
-                        'temperature': temperature, # sampling temperature
-                        'num_predict': max_tokens, # max number of decoded tokens before interrupt
-                        'keep_alive': "3h"
-                        } 
-    
-    def get_action(self, prompt, context):
-        return ollama.generate(model=self.model_name,
-                        prompt=prompt,
-                        options=self.options,
-                        context = context)
+from optimal_agent import get_best_move, is_legal_move
+from context_window import context_window_for
+from telemetry import LLMTelemetry
+from llm_cache import PreferenceCache
+from action_formats import get_action_schema, get_schema_hint, parse_structured_action
 
 def extract_isolated_pair(text):
     # Define the pattern:
@@ -41,18 +37,24 @@ def extract_isolated_pair(text):
     else:
         return -1, -1
     
-def extract_move_RushHour(text):
+def extract_move_RushHour(text, verbose=True):
     match = re.search(r"MOVE:\s*([A-Za-z][+-])", text)
     if match:
         move = match.group(1)
-        print(move)  # e.g. "+A"
+        if verbose:
+            print(move)  # e.g. "+A"
     else:
-        print("No move found.")
+        if verbose:
+            print("No move found.")
         return -1
     return move
 
     
 def format_action(text, env_id):
+    # responses constrained by an action_formats schema are JSON and need no pattern matching
+    structured = parse_structured_action(text, env_id)
+    if structured != -1:
+        return structured
     if "TowerOfHanoi-v0" in env_id:
         A, B = extract_isolated_pair(text)
         return f"[{A} {B}]"
@@ -62,6 +64,35 @@ def format_action(text, env_id):
     else:
         return "UNKOWN ENV"
 
+def parse_action(text, env_id):
+    """
+    Like format_action, but returns -1 when no move can be found in text.
+    """
+    structured = parse_structured_action(text, env_id)
+    if structured != -1:
+        return structured
+    if "TowerOfHanoi-v0" in env_id:
+        A, B = extract_isolated_pair(text)
+        return -1 if A == -1 else f"[{A} {B}]"
+    elif "RushHour-v0" in env_id:
+        return extract_move_RushHour(text, verbose=False)
+    return -1
+
+def stream_action_parser(env_id):
+    """
+    Returns a parser for agent.get_action(..., stop_parser=...) that recognizes a complete move
+    in a partially decoded response and returns -1 until then.
+    """
+    def parser(text):
+        structured = parse_structured_action(text, env_id)
+        if structured != -1:
+            return structured
+        # a move that ends the text could still grow (e.g. "A C" -> "A CB"), so wait for the character after it
+        if not text or text[-1].isalnum():
+            return -1
+        return parse_action(text, env_id)
+    return parser
+
 if __name__ == "__main__":
     env_id = "TowerOfHanoi-v0"
     #cache_path = "hanoi_caches/hanoi_4disk_LLM_replay_sep_cache_2.json"
@@ -91,15 +122,76 @@ if __name__ == "__main__":
         #     with open(cache_path, 'w') as fp:
         #         json.dump(tmp, fp)
         
-        with open(cache_path, 'r') as fp:
-            experience_cache = json.load(fp)
+        # every finished episode is appended to the .jsonl store right away, the .json cache is a snapshot of it
+        experience_store = ExperienceStore(cache_path.replace('.json', '.jsonl'), legacy_path=cache_path)
+        experience_cache = experience_store.load()
         #agent = ContextAgentLLM(model_name='hoangquan456/qwen3-nothink:8b', context_size=40000, temperature=0.5, max_tokens=1000)
-        agent = ContextAgentLLM(model_name='Llama3.1:8b', context_size=32768, temperature=0.5, max_tokens=5000)
+        offline = False # answer with the optimal-move oracle instead of a model server (harness benchmarks, CI)
+        stream_actions = True # stop decoding as soon as a move can be parsed from the response
+        keep_last_turns = 10 # turns kept verbatim when the context has to be compacted to fit num_ctx
+        use_output_schema = False # constrain the model to a JSON move, e.g. {"from": "A", "to": "C"}
+        if use_output_schema:
+            append_text += " " + get_schema_hint(env_id)
+        ollama_hosts = None # e.g. ["http://gpu1:11434", "http://gpu2:11434"] to spread episodes over several servers
+        call_timeout = 600 # seconds before a stalled call is abandoned and retried (answers can be up to 5000 tokens)
+        max_retries = 3 # retries (with jittered exponential backoff) for timeouts and server errors
+        hedge_requests = False # duplicate calls slower than the recent p95 latency and keep the first answer
+        cascade_models = None # e.g. ["phi3:3.8b"], smaller models asked first, smallest first; escalates when unsure
+        selection_method = 'LLM' # 'LLM' knockout tournament, 'elo' for persistent ratings under a fixed budget,
+                                 # 'progress' to rank by distance-to-solution scores (no model calls),
+                                 # or 'prioritized' to draw replays weighted by priority_source
+        priority_source = 'progress' # 'progress', 'outcome' or 'recency'
+        selection_budget = 8 # comparisons per episode with selection_method = 'elo'
+        replay_format = 'raw' # 'compact': replays go in the prompt as move lists with a few board snapshots
+        diverse_selection = False # random / recent / LLM: skip near-duplicate replays (MinHash + maximal marginal relevance)
+        selection_workers = 4 # replay comparisons of a tournament round sent to the server at once
+        selection_seed = 0 # fixed seed: pairings stay mostly the same as the cache grows, None for unseeded
+        # judged replay pairs, next to the cache they belong to, so each tournament only pays for new replays
+        preference_cache = PreferenceCache(cache_path.replace('.json', '_preferences.json'))
+        replay_ratings = ReplayRatings(cache_path.replace('.json', '_ratings.json'))
+        replay_scores = ReplayScores(cache_path.replace('.json', '_scores.json'), lambda run: replay_quality(run, n_disks=4))
+        buffer_capacity = None # most replays kept in the cache, None to keep every one
+        eviction_policy = 'fifo' # 'fifo', 'reservoir', 'lrs' (least recently selected) or 'quality' (lowest replay_quality score)
+        experience_cache = ExperienceBuffer(experience_cache, buffer_capacity, eviction_policy, replay_scores.score,
+                                            store=experience_store)
+        # only needed to skip near-duplicates, so it is not built otherwise
+        minhash_index = MinHashIndex(cache_path.replace('.json', '_minhash.json')) if diverse_selection else None
+        replay_store_path = None # e.g. "replays.db": every episode is also filed there, in a view named after the cache
+        replay_store = ReplayStore(replay_store_path) if replay_store_path is not None else None
+        if replay_store is not None:
+            cache_view = os.path.splitext(os.path.basename(cache_path))[0]
+            replay_store.add_view(cache_view, experience_cache)
+        sampler = PrioritizedSampler(cache_path.replace('.json', '_priorities.json'), priority_source, replay_scores)
+        if offline:
+            backend = ScriptedBackend(hanoi_oracle_responder)
+        elif ollama_hosts is not None:
+            backend = RoutingBackend(ollama_hosts, timeout=call_timeout)
+        else:
+            backend = OllamaBackend(timeout=call_timeout)
+        # the http timeout bounds every read, so a streamed step that stalls is cut off too
+        backend = ResilientBackend(backend, timeout=call_timeout, max_retries=max_retries, hedge=hedge_requests)
+        # per call token counts and timings, next to the cache they belong to
+        telemetry = LLMTelemetry(cache_path.replace('.json', '_llm_calls.jsonl'), env=env_id)
+        agent = ContextAgentLLM(model_name='Llama3.1:8b', context_size=32768, temperature=0.5, max_tokens=5000, backend=backend,
+                                output_format=get_action_schema(env_id) if use_output_schema else None,
+                                telemetry=telemetry, keep_alive="3h")
+        selection_agent = agent # replay comparisons answer "1" or "2", which a move-checking cascade would escalate
+        if cascade_models is not None:
+            # small tiers only need to name a move, a wrong or unsure one is escalated to the model above
+            small_agents = [ContextAgentLLM(model_name=model, context_size=32768, temperature=0, max_tokens=50, backend=backend,
+                                            output_format=get_action_schema(env_id) if use_output_schema else None,
+                                            telemetry=telemetry, keep_alive="3h") for model in cascade_models]
+            validator = (lambda action, prompt: is_legal_move(prompt, action)) if "TowerOfHanoi-v0" in env_id else None
+            agent = CascadeAgentLLM(small_agents + [agent], parser=lambda text: parse_action(text, env_id),
+                                    validator=validator, keep_last=keep_last_turns)
+        agent.warmup()
         thinking_chains = {}
         for episode in range(0, 10):
             thinking_chains[episode] = []
+            telemetry.set_tags(episode=episode)
             # Create fresh environment for each episode
-            env = ta.make(env_id=env_id, num_disks = 4, max_turns=30)
+            env_params = {'num_disks': 4, 'max_turns': 30}
+            env = ta.make(env_id=env_id, **env_params)
             #env = ta.make(env_id=env_id, difficulty="easy")
             env.reset(num_players=1)
 
@@ -117,6 +209,8 @@ if __name__ == "__main__":
 
             # Context for ollama (maintains conversation state)
             current_context = []
+            # the first turn carries the rules and replay buffer, so it is pinned when old turns are dropped
+            window = context_window_for(agent, keep_last=keep_last_turns, pin_first_turns=1)
 
             # Track how much of the observation we've already processed
             prev_obs_len = 0
@@ -125,12 +219,16 @@ if __name__ == "__main__":
             #selected_runs = []
 
             #selected_runs = []
-            selected_runs = buffer_selection(experience_cache, 'LLM', 3, agent)
+            selected_runs = buffer_selection(experience_cache, selection_method, 3, selection_agent, selection_workers,
+                                             selection_seed, preference_cache, replay_ratings, selection_budget,
+                                             scores=replay_scores, minhash=minhash_index,
+                                             sampler=sampler)
             #selected_runs = []
             #selected_runs = [experience_cache[0]]
             if selected_runs == -1:
                 print("ERROR OCCURED")
                 break
+            experience_cache.mark_selected(selected_runs)
 
             # Slice to the last 3 runs first
             if len(selected_runs) > 3:
@@ -138,37 +236,28 @@ if __name__ == "__main__":
 
             if len(selected_runs) != 0:
                 processed_runs = []
+                encoded_runs = []
                 
                 for run in selected_runs:
+                    # recorded episodes know how they ended, older transcripts fall back to their last sentence
+                    last_sentence = episode_outcome(run)
                     run = run.strip()
-                    
-                    # 1. Find all punctuation indices (. ! ?)
-                    # We use finditer to get the exact positions of punctuation
-                    punct_matches = list(re.finditer(r'[.!?]', run))
-                    
-                    last_sentence = ""
-                    
-                    # Logic: If we have at least 2 punctuation marks, grab everything 
-                    # after the second-to-last one.
-                    if len(punct_matches) >= 2:
-                        # Get the end index of the second-to-last punctuation mark
-                        split_index = punct_matches[-2].end()
-                        last_sentence = run[split_index:].strip()
-                    elif len(punct_matches) == 1:
-                        # If there is only one sentence, take the whole thing
-                        last_sentence = run.strip()
-                    else:
-                        # Fallback if no punctuation is found
-                        last_sentence = run.strip()[-100:] # Just take last 100 chars as fallback
-                        
-                    # 2. Format the specific run string
+
+                    # Format the specific run string
+                    body = encode_replay(run, env_id) if replay_format == 'compact' else run
                     formatted_run = (
                         f"[Start of run]\n"
                         f"During this run: {last_sentence}\n\n"
-                        f"{run}\n"
+                        f"{body}\n"
                         f"[End of run]"
                     )
                     processed_runs.append(formatted_run)
+                    encoded_runs.append(body)
+
+                if replay_format == 'compact':
+                    report = encoding_report([run.strip() for run in selected_runs], encoded_runs)
+                    print(f"Compact replays: ~{report['raw_tokens']} -> ~{report['encoded_tokens']} tokens "
+                          f"({report['saved_fraction']:.0%} saved)")
 
                 # Join the processed runs
                 buffer_text = "\n\nHere are some past attempts you made for you to draw experience from:\n" \
@@ -191,6 +280,7 @@ if __name__ == "__main__":
 
             buffer_len = len(buffer_text)
             print(f"Using {len(selected_runs)} past runs in buffer")
+            record = new_episode_record(env_id, env_params, agent, selection_method, len(selected_runs))
 
             while not done:
                 player_id, full_observation = env.get_observation()
@@ -207,6 +297,8 @@ if __name__ == "__main__":
 
                 # Extract only the NEW part of the observation
                 new_observation = full_observation[prev_obs_len:]
+                # the part of it that goes in the transcript
+                transcript_start = max(prev_obs_len, gameplay_offset)
 
                 print("=" * 50)
                 print("NEW OBSERVATION START")
@@ -232,12 +324,14 @@ if __name__ == "__main__":
 
                 # Get action from agent
                 print("CURRENT CONTEXT LEN", len(current_context))
-                action_response = agent.get_action(observation_to_send, current_context)
+                action_response = agent.get_action(observation_to_send, current_context,
+                                                   stop_parser=stream_action_parser(env_id) if stream_actions else None,
+                                                   tags={'episode': episode, 'step': len(window.turn_tokens)})
                 #action = get_best_move(observation_to_send)
                 #print(action_response)
                 # print(action_response['thinking'])
                 # thinking_chains[episode].append(action_response['thinking'])
-                current_context = action_response['context']
+                current_context = window.update(action_response['context'])
 
                 print("RESPONSE START")
                 print(action_response["response"])
@@ -247,6 +341,9 @@ if __name__ == "__main__":
                 action = format_action(action_response['response'], env_id)
                 print(f"Formatted action: {action}")
 
+                board, distance = board_distance(full_observation[transcript_start:], n_disks=env_params['num_disks'])
+                add_step(record, full_observation[transcript_start:], action, action_response, board=board, distance=distance)
+
                 # Take step in environment
                 done, step_info = env.step(action=action)
 
@@ -276,12 +373,38 @@ if __name__ == "__main__":
             #     full_episode_text = full_episode_text + "\n" + game_info[0]["reason"]
             # if rewards[0] == 1.0:
             #     full_episode_text = full_episode_text + "\n" + game_info[0]["reason"]
-            full_episode_text = full_episode_text + "\n" + game_info[0]["reason"]
-            experience_cache.append(full_episode_text)
+            board, distance = board_distance(final_observation[prev_obs_len:], n_disks=env_params['num_disks'])
+            finish_episode(record, rewards[0], game_info[0]["reason"], final_observation[prev_obs_len:],
+                           final_board=board, final_distance=distance)
+            # the transcript (gameplay only, then the reason the game ended) is rendered from the record
+            full_episode_text = EpisodeText(record)
+            replay_scores.add(full_episode_text)
+            if minhash_index is not None:
+                duplicates = minhash_index.near_duplicates(full_episode_text, list(experience_cache))
+                if len(duplicates) > 0:
+                    print(f"New replay is a near-duplicate of {len(duplicates)} stored replays")
+            n_evictions = len(experience_cache.evictions)
+            kept = experience_cache.append(full_episode_text)
+            if replay_store is not None:
+                # the view mirrors the buffer: evicted replays leave it, a replay the buffer rejected never joins
+                for eviction in experience_cache.evictions[n_evictions:]:
+                    if not eviction['new_replay']:
+                        replay_store.remove_from_view(cache_view, eviction['hash'])
+                if kept:
+                    replay_store.add(full_episode_text, view=cache_view)
 
         # Save updated cache
-        with open(cache_path, 'w') as fp:
-            json.dump(experience_cache, fp, indent=2)
+        experience_store.export(experience_cache, cache_path)
+        experience_store.close()
+        experience_cache.print_stats()
+        if replay_store is not None:
+            replay_store.print_summary()
+            replay_store.close()
+        agent.close()
+        if cascade_models is not None:
+            agent.print_summary()
+        telemetry.print_summary()
+        telemetry.close()
         
         # for i in range(0, 100):
         #     f_name = f"{cache_path.split('.')[0]}_COT_{i}.json"
@@ -0,0 +1,615 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import httpx
+import ollama
+from optimal_agent import get_best_move
+from telemetry import percentile
+
+class LLMBackend:
+    """
+    Interface between the agents and whatever serves the model.
+    generate / agenerate take the same keyword arguments as ollama.generate (model, prompt, options,
+    context, ...) and return a dict-like response with at least 'response', 'context',
+    'prompt_eval_count', 'eval_count' and the matching *_duration fields (in nanoseconds).
+    generate_stream / agenerate_stream yield partial responses instead; only the last one has done=True
+    and carries the context. Closing the stream early stops decoding.
+    Requests may also carry session, an affinity hint (e.g. the episode) that routing backends use to
+    keep a conversation on one server; other backends ignore it.
+    """
+    def generate(self, **request):
+        raise NotImplementedError
+
+    async def agenerate(self, **request):
+        raise NotImplementedError
+
+    def generate_stream(self, **request):
+        raise NotImplementedError
+
+    async def agenerate_stream(self, **request):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+    def health_check(self):
+        return True
+
+def to_dict(response):
+    # ollama returns pydantic models, everything downstream is happy with a plain dict
+    if hasattr(response, 'model_dump'):
+        return response.model_dump()
+    return dict(response)
+
+class OllamaBackend(LLMBackend):
+    def __init__(self, host=None, max_connections=8, timeout=None):
+        self.host = host
+        # both clients keep a pool of connections open to the server between calls.
+        # timeout (seconds) bounds connecting and every read, so it also catches a stream that stalls
+        self.client = ollama.Client(host=host, timeout=timeout)
+        self.async_client = ollama.AsyncClient(host=host, timeout=timeout,
+                                               limits=httpx.Limits(max_connections=max_connections,
+                                                                   max_keepalive_connections=max_connections))
+
+    def generate(self, session=None, **request):
+        return self.client.generate(**request)
+
+    async def agenerate(self, session=None, **request):
+        return await self.async_client.generate(**request)
+
+    def generate_stream(self, session=None, **request):
+        return self.client.generate(stream=True, **request)
+
+    async def agenerate_stream(self, session=None, **request):
+        return await self.async_client.generate(stream=True, **request)
+
+    def health_check(self):
+        try:
+            self.client.list()
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        # the ollama clients do not expose close(), their httpx clients do
+        self.client._client.close()
+
+    async def aclose(self):
+        await self.async_client._client.aclose()
+
+def is_endpoint_failure(error):
+    # connection problems and server side errors mean the host is in trouble, a bad request does not
+    if isinstance(error, (ConnectionError, httpx.TransportError)):
+        return True
+    return isinstance(error, ollama.ResponseError) and error.status_code >= 500
+
+class RoutingBackend(LLMBackend):
+    """
+    Spreads calls over several ollama servers. endpoints is a list of host urls or LLMBackend objects.
+    A context token list is only cheap to continue on the server whose KV cache already holds it, so calls
+    that share a session (the episode) stick to the endpoint that served the first of them. Calls without
+    a session, and sessions whose endpoint went down, go to the healthy endpoint with the fewest
+    outstanding requests. Endpoints are health checked every health_interval seconds in a background
+    thread; one that fails a check or a call is drained (gets no new calls) until a check passes again.
+    A failed non-streamed call is retried on the next endpoint.
+    """
+    def __init__(self, endpoints, health_interval=15.0, max_connections=8, timeout=None):
+        self.endpoints = [OllamaBackend(host=e, max_connections=max_connections, timeout=timeout) if isinstance(e, str) else e
+                          for e in endpoints]
+        self.names = [e if isinstance(e, str) else f"endpoint {i}" for i, e in enumerate(endpoints)]
+        self.outstanding = [0] * len(self.endpoints)
+        self.healthy = [True] * len(self.endpoints)
+        self.served = [0] * len(self.endpoints)
+        self.sessions = {} # session -> endpoint index
+        self.n_failovers = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.health_thread = None
+        if health_interval:
+            self.health_thread = threading.Thread(target=self.health_loop, args=(health_interval,), daemon=True)
+            self.health_thread.start()
+
+    def pick(self, session, exclude=()):
+        with self.lock:
+            idx = self.sessions.get(session) if session is not None else None
+            if idx is None or not self.healthy[idx] or idx in exclude:
+                candidates = [i for i in range(len(self.endpoints)) if self.healthy[i] and i not in exclude]
+                if len(candidates) == 0:
+                    # everything looks down, try the endpoints we have not tried yet anyway
+                    candidates = [i for i in range(len(self.endpoints)) if i not in exclude]
+                # ties (e.g. a sequential runner) go to the endpoint holding the fewest sessions
+                pinned = [list(self.sessions.values()).count(i) for i in range(len(self.endpoints))]
+                idx = min(candidates, key=lambda i: (self.outstanding[i], pinned[i], self.served[i]))
+                if session is not None:
+                    self.sessions[session] = idx
+            self.outstanding[idx] += 1
+            self.served[idx] += 1
+            return idx
+
+    def release(self, idx):
+        with self.lock:
+            self.outstanding[idx] -= 1
+
+    def mark_unhealthy(self, idx, error):
+        with self.lock:
+            if self.healthy[idx]:
+                print(f"Draining {self.names[idx]}: {error}")
+            self.healthy[idx] = False
+
+    def generate(self, session=None, **request):
+        tried = []
+        while True:
+            idx = self.pick(session, exclude=tried)
+            try:
+                return self.endpoints[idx].generate(**request)
+            except Exception as error:
+                if not is_endpoint_failure(error):
+                    raise
+                self.mark_unhealthy(idx, error)
+                tried.append(idx)
+                if len(tried) == len(self.endpoints):
+                    raise
+                self.n_failovers += 1
+            finally:
+                self.release(idx)
+
+    async def agenerate(self, session=None, **request):
+        tried = []
+        while True:
+            idx = self.pick(session, exclude=tried)
+            try:
+                return await self.endpoints[idx].agenerate(**request)
+            except Exception as error:
+                if not is_endpoint_failure(error):
+                    raise
+                self.mark_unhealthy(idx, error)
+                tried.append(idx)
+                if len(tried) == len(self.endpoints):
+                    raise
+                self.n_failovers += 1
+            finally:
+                self.release(idx)
+
+    def generate_stream(self, session=None, **request):
+        idx = self.pick(session)
+        try:
+            stream = self.endpoints[idx].generate_stream(**request)
+        except Exception:
+            self.release(idx)
+            raise
+        return self.release_after(stream, idx)
+
+    def release_after(self, stream, idx):
+        try:
+            yield from stream
+        except Exception as error:
+            if is_endpoint_failure(error):
+                self.mark_unhealthy(idx, error)
+            raise
+        finally:
+            self.release(idx)
+
+    async def agenerate_stream(self, session=None, **request):
+        idx = self.pick(session)
+        try:
+            stream = await self.endpoints[idx].agenerate_stream(**request)
+        except Exception:
+            self.release(idx)
+            raise
+        return self.arelease_after(stream, idx)
+
+    async def arelease_after(self, stream, idx):
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception as error:
+            if is_endpoint_failure(error):
+                self.mark_unhealthy(idx, error)
+            raise
+        finally:
+            await stream.aclose()
+            self.release(idx)
+
+    def health_check(self):
+        return any(endpoint.health_check() for endpoint in self.endpoints)
+
+    def health_loop(self, interval):
+        while not self.stop_event.wait(interval):
+            for idx, endpoint in enumerate(self.endpoints):
+                ok = endpoint.health_check()
+                with self.lock:
+                    if ok and not self.healthy[idx]:
+                        print(f"{self.names[idx]} is healthy again")
+                    elif not ok and self.healthy[idx]:
+                        print(f"Draining {self.names[idx]}: failed health check")
+                    self.healthy[idx] = ok
+
+    def stats(self):
+        with self.lock:
+            return {name: {'healthy': self.healthy[i], 'outstanding': self.outstanding[i], 'served': self.served[i]}
+                    for i, name in enumerate(self.names)}
+
+    def close(self):
+        self.stop_event.set()
+        for endpoint in self.endpoints:
+            endpoint.close()
+
+    async def aclose(self):
+        self.stop_event.set()
+        for endpoint in self.endpoints:
+            await endpoint.aclose()
+
+def is_retryable(error):
+    # a call that ran past its deadline or hit a struggling server may well succeed on a second try
+    return isinstance(error, TimeoutError) or is_endpoint_failure(error)
+
+class ResilientBackend(LLMBackend):
+    """
+    Wraps another backend so a stalled or failed call does not hang or kill a whole run.
+    Every call gets a deadline of timeout seconds; timeouts and server side errors are retried up to
+    max_retries times after an exponential, jittered backoff. With hedge=True, a call that is still running
+    after the hedge_quantile percentile of recent latencies gets a duplicate request and whichever answers
+    first is used (the duplicate drops the session hint, so a router can send it to a different server).
+    Responses are returned as dicts with 'attempts' and 'hedged' added; every retry and hedge is also
+    kept in events.
+    Streams are retried only while nothing has been received yet and are never hedged.
+    """
+    def __init__(self, backend, timeout=300.0, max_retries=3, backoff=1.0, max_backoff=30.0,
+                 hedge=False, hedge_quantile=95, hedge_min_samples=20, max_workers=16):
+        self.backend = backend
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples # no hedging until the latency percentile means something
+        self.latencies = deque(maxlen=500) # seconds, successful calls only
+        # sync calls run in worker threads so the caller can give up on them (a thread cannot be killed,
+        # a timed out call keeps its worker until the server answers or the http client times out)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.events = []
+        self.counts = {'calls': 0, 'retries': 0, 'timeouts': 0, 'hedges': 0, 'hedge_wins': 0, 'failures': 0}
+        self.lock = threading.Lock()
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        return percentile(sorted(self.latencies), self.hedge_quantile)
+
+    def backoff_delay(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * random.uniform(0.5, 1.0)
+
+    def record(self, kind, **fields):
+        with self.lock:
+            self.counts[kind] += 1
+            if kind != 'calls':
+                self.events.append({'time': time.time(), 'kind': kind, **fields})
+
+    def hedge_request(self, request):
+        return {k: v for k, v in request.items() if k != 'session'}
+
+    def finish(self, response, latency, attempt, hedged):
+        with self.lock:
+            self.latencies.append(latency)
+        response = to_dict(response)
+        response['attempts'] = attempt + 1
+        response['hedged'] = hedged
+        return response
+
+    def give_up_or_wait(self, error, attempt):
+        # returns how long to sleep before the next attempt, or re-raises when it should not be retried
+        if isinstance(error, TimeoutError):
+            self.record('timeouts', attempt=attempt)
+        if not is_retryable(error) or attempt == self.max_retries:
+            self.record('failures', attempt=attempt, error=repr(error))
+            raise error
+        delay = self.backoff_delay(attempt)
+        self.record('retries', attempt=attempt, error=repr(error), delay=delay)
+        print(f"LLM call failed ({error!r}), retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        return delay
+
+    def attempt(self, request, hedge_delay):
+        start = time.perf_counter()
+        primary = self.executor.submit(self.backend.generate, **request)
+        pending = {primary}
+        hedged = False
+        error = None
+        while pending:
+            elapsed = time.perf_counter() - start
+            wait_time = self.timeout - elapsed
+            if hedge_delay is not None and not hedged:
+                wait_time = min(wait_time, hedge_delay - elapsed)
+            done, pending = wait(pending, timeout=max(wait_time, 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self.record('hedge_wins')
+                    return future.result(), time.perf_counter() - start, hedged
+                error = future.exception()
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.timeout:
+                break
+            if pending and not hedged and hedge_delay is not None and elapsed >= hedge_delay:
+                self.record('hedges', after=elapsed)
+                pending.add(self.executor.submit(self.backend.generate, **self.hedge_request(request)))
+                hedged = True
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"no response within {self.timeout}s")
+
+    def generate(self, **request):
+        self.record('calls')
+        attempt = 0
+        while True:
+            try:
+                response, latency, hedged = self.attempt(request, self.hedge_delay())
+                return self.finish(response, latency, attempt, hedged)
+            except Exception as error:
+                time.sleep(self.give_up_or_wait(error, attempt))
+            attempt += 1
+
+    async def aattempt(self, request, hedge_delay):
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(self.backend.agenerate(**request))
+        pending = {primary}
+        hedged = False
+        error = None
+        try:
+            while pending:
+                elapsed = time.perf_counter() - start
+                wait_time = self.timeout - elapsed
+                if hedge_delay is not None and not hedged:
+                    wait_time = min(wait_time, hedge_delay - elapsed)
+                done, pending = await asyncio.wait(pending, timeout=max(wait_time, 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.record('hedge_wins')
+                        return task.result(), time.perf_counter() - start, hedged
+                    error = task.exception()
+                elapsed = time.perf_counter() - start
+                if elapsed >= self.timeout:
+                    break
+                if pending and not hedged and hedge_delay is not None and elapsed >= hedge_delay:
+                    self.record('hedges', after=elapsed)
+                    pending.add(asyncio.ensure_future(self.backend.agenerate(**self.hedge_request(request))))
+                    hedged = True
+        finally:
+            # unlike threads, the losing or timed out requests can be cancelled
+            for task in pending:
+                task.cancel()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"no response within {self.timeout}s")
+
+    async def agenerate(self, **request):
+        self.record('calls')
+        attempt = 0
+        while True:
+            try:
+                response, latency, hedged = await self.aattempt(request, self.hedge_delay())
+                return self.finish(response, latency, attempt, hedged)
+            except Exception as error:
+                await asyncio.sleep(self.give_up_or_wait(error, attempt))
+            attempt += 1
+
+    def generate_stream(self, **request):
+        self.record('calls')
+        return self.retry_stream(request)
+
+    def retry_stream(self, request):
+        attempt = 0
+        while True:
+            try:
+                stream = self.backend.generate_stream(**request)
+                first = next(stream)
+                break
+            except StopIteration:
+                return
+            except Exception as error:
+                time.sleep(self.give_up_or_wait(error, attempt))
+            attempt += 1
+        # once text has been handed out a failure can no longer be retried transparently
+        try:
+            yield first
+            yield from stream
+        finally:
+            stream.close()
+
+    async def agenerate_stream(self, **request):
+        self.record('calls')
+        return self.aretry_stream(request)
+
+    async def aretry_stream(self, request):
+        attempt = 0
+        while True:
+            stream = None
+            try:
+                stream = await asyncio.wait_for(self.backend.agenerate_stream(**request), self.timeout)
+                first = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                break
+            except StopAsyncIteration:
+                return
+            except Exception as error:
+                if stream is not None:
+                    await stream.aclose()
+                await asyncio.sleep(self.give_up_or_wait(error, attempt))
+            attempt += 1
+        try:
+            yield first
+            while True:
+                # a stream that goes quiet for a whole timeout is treated as stalled
+                try:
+                    chunk = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    def health_check(self):
+        return self.backend.health_check()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+        stats['hedge_delay'] = self.hedge_delay()
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.backend.close()
+
+    async def aclose(self):
+        self.executor.shutdown(wait=False)
+        await self.backend.aclose()
+
+def fake_tokenize(text):
+    # stable word level stand-in for a real tokenizer, enough to give contexts and counts a realistic shape
+    return [int(hashlib.md5(w.encode('utf-8')).hexdigest()[:6], 16) % 32000 for w in text.split()]
+
+class ScriptedBackend(LLMBackend):
+    """
+    Deterministic offline stand-in for a model server.
+    responder is either a list of responses (handed out in order, cycling, one per distinct request) or a
+    function responder(prompt, context) -> str. An identical request (same prompt and context, e.g. the
+    replay of a stream stopped early) gets the same answer again. The returned dict has the same shape as
+    an ollama response, so agents and runners can be exercised and benchmarked without a live model.
+    Like ollama, raw calls ignore the context they are sent and return none.
+    delay adds a fixed per-call latency in seconds to emulate a server round trip.
+    """
+    def __init__(self, responder, delay=0.0):
+        self.responder = responder
+        self.delay = delay
+        self.n_calls = 0
+        self.answers = {} # request key -> answer, for list responders
+
+    def respond(self, prompt, context, options, raw=False):
+        if prompt == "":
+            # like ollama, an empty prompt only loads the model
+            return "", []
+        if raw:
+            context = None
+        if callable(self.responder):
+            text = self.responder(prompt, context)
+        else:
+            key = hashlib.sha256(repr((prompt, list(context or []))).encode('utf-8')).hexdigest()
+            if key not in self.answers:
+                self.answers[key] = self.responder[len(self.answers) % len(self.responder)]
+            text = self.answers[key]
+        self.n_calls += 1
+
+        num_predict = (options or {}).get('num_predict')
+        response_tokens = fake_tokenize(text)
+        if num_predict is not None and num_predict >= 0 and len(response_tokens) > num_predict:
+            text = " ".join(text.split()[:num_predict])
+            response_tokens = response_tokens[:num_predict]
+        return text, response_tokens
+
+    def build_response(self, model, prompt, context, text, response_tokens, start, logprobs=False, raw=False):
+        prompt_tokens = fake_tokenize(prompt)
+        duration = time.perf_counter_ns() - start
+        response = {'model': model,
+                'response': text,
+                'done': True,
+                'context': None if raw else list(context or []) + prompt_tokens + response_tokens,
+                'prompt_eval_count': len(prompt_tokens),
+                'eval_count': len(response_tokens),
+                'load_duration': 0,
+                'prompt_eval_duration': duration // 2,
+                'eval_duration': duration - duration // 2,
+                'total_duration': duration}
+        if logprobs:
+            # every scripted word is reported as a near certain token with no alternatives
+            response['logprobs'] = [{'token': w, 'logprob': -0.01, 'top_logprobs': [{'token': w, 'logprob': -0.01}]}
+                                    for w in re.findall(r'\s*\S+', text)]
+        return response
+
+    def generate(self, model=None, prompt='', options=None, context=None, **kwargs):
+        start = time.perf_counter_ns()
+        if self.delay:
+            time.sleep(self.delay)
+        text, response_tokens = self.respond(prompt, context, options, kwargs.get('raw', False))
+        return self.build_response(model, prompt, context, text, response_tokens, start, kwargs.get('logprobs', False),
+                                   kwargs.get('raw', False))
+
+    async def agenerate(self, model=None, prompt='', options=None, context=None, **kwargs):
+        start = time.perf_counter_ns()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        text, response_tokens = self.respond(prompt, context, options, kwargs.get('raw', False))
+        return self.build_response(model, prompt, context, text, response_tokens, start, kwargs.get('logprobs', False),
+                                   kwargs.get('raw', False))
+
+    def generate_stream(self, model=None, prompt='', options=None, context=None, **kwargs):
+        start = time.perf_counter_ns()
+        if self.delay:
+            time.sleep(self.delay)
+        text, response_tokens = self.respond(prompt, context, options, kwargs.get('raw', False))
+        return self.stream_chunks(model, prompt, context, text, response_tokens, start, kwargs.get('raw', False))
+
+    async def agenerate_stream(self, model=None, prompt='', options=None, context=None, **kwargs):
+        start = time.perf_counter_ns()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        text, response_tokens = self.respond(prompt, context, options, kwargs.get('raw', False))
+
+        async def chunks():
+            for chunk in self.stream_chunks(model, prompt, context, text, response_tokens, start, kwargs.get('raw', False)):
+                yield chunk
+        return chunks()
+
+    def stream_chunks(self, model, prompt, context, text, response_tokens, start, raw=False):
+        words = text.split()
+        for i, word in enumerate(words):
+            yield {'response': word if i == len(words) - 1 else word + " ", 'done': False}
+        final = self.build_response(model, prompt, context, text, response_tokens, start, raw=raw)
+        final['response'] = ""
+        yield final
+
+def hanoi_oracle_responder(prompt, context):
+    # parse_board keeps the last board it finds, which is the current one in a Hanoi observation
+    move = get_best_move(prompt)
+    if not move.startswith('['):
+        return move
+    return f"MOVE: {move[1:-1]}"
+
+def babyai_rule_responder(prompt, context):
+    """
+    Simple greedy BabyAI-Text policy: face the mission object, walk to it and pick it up if asked to.
+    """
+    missions = re.findall(r"you are trying to find and (.*?)\. Please respond", prompt)
+    if not missions:
+        return "turn left"
+    mission = missions[-1]
+    target = re.sub(r"^(go to|pick up)\s+(the|a)\s+", "", mission).strip()
+
+    # only look at the descriptions received since the last action request
+    chunks = prompt.split("Your selected output action is")
+    last_obs = chunks[-2] if len(chunks) > 1 else prompt
+    seen = re.findall(r"You see a (.*?) (\d+) steps? (left|right|forward)(?: and (\d+) steps? (forward))?", last_obs)
+    for obj, n, direction, n_forward, _ in seen:
+        if target not in obj:
+            continue
+        if direction == 'left':
+            return "turn left"
+        if direction == 'right':
+            return "turn right"
+        if int(n) == 1 and mission.startswith('pick up'):
+            return "pick up"
+        return "go forward"
+
+    if "You see a wall 1 step forward" in last_obs:
+        return "turn left"
+    return "go forward"
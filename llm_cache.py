@@ -0,0 +1,159 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from llm_backends import to_dict
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class PrefixCache:
+    """
+    LRU cache of ollama context token lists for static prompt prefixes (rules + replay buffer).
+    Entries are keyed by model name, options and a hash of the prefix text, so changing any of
+    them forces a fresh evaluation. If path is given, the cache is loaded from and saved to that json file.
+    """
+    def __init__(self, max_entries=16, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def make_key(self, model_name, options, prefix):
+        # num_predict only affects decoding, not how the prefix itself is evaluated
+        key_options = {k: v for k, v in options.items() if k != 'num_predict'}
+        return json.dumps([model_name, key_options, hash_text(prefix)], sort_keys=True)
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        # hand out a copy so callers can extend their context without touching the cache
+        return list(self.entries[key])
+
+    def put(self, key, context):
+        self.entries[key] = list(context)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        if self.path is not None:
+            self.save()
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            stored = json.load(fp)
+        self.entries = OrderedDict(stored[-self.max_entries:])
+
+    def save(self):
+        # stored as a list of [key, context] pairs to keep the LRU order
+        with open(self.path, 'w') as fp:
+            json.dump(list(self.entries.items()), fp)
+
+class PreferenceCache:
+    """
+    Remembers which of two replays the judge model kept in buffer_selection.compare_replays, so a
+    tournament over a grown experience cache only asks about pairs it has not judged yet.
+    Entries are keyed by model name and the hashes of the two replays in the order they were shown,
+    since the answer can depend on which replay comes first. If path is given, the cache is loaded from
+    that json file and save() writes it back.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock() # tournament matches run in parallel threads
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def make_key(self, model_name, replay_a, replay_b):
+        return f"{model_name}:{hash_text(replay_a)}:{hash_text(replay_b)}"
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.entries[key]
+
+    def put(self, key, winner):
+        with self.lock:
+            self.entries[key] = winner
+
+    def judged_pairs(self, model_name):
+        # (hash shown first, hash shown second) of every pair model_name has judged
+        with self.lock:
+            keys = list(self.entries)
+        pairs = set()
+        for key in keys:
+            # model names can contain ':' themselves (e.g. Llama3.1:8b), the two hashes cannot
+            name, hash_a, hash_b = key.rsplit(':', 2)
+            if name == model_name:
+                pairs.add((hash_a, hash_b))
+        return pairs
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            self.entries = json.load(fp)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            with open(self.path, 'w') as fp:
+                json.dump(self.entries, fp)
+
+class ResponseCache:
+    """
+    On-disk memo of generate responses for deterministic (temperature=0) runs, stored in SQLite.
+    Entries are keyed by model name, options, prompt and a hash of the incoming context. Once more
+    than max_entries are stored, the least recently used ones are evicted.
+    """
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, last_used REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+
+    def make_key(self, model_name, options, prompt, context):
+        context_hash = hash_text(json.dumps(list(context or [])))
+        return hash_text(json.dumps([model_name, options, prompt, context_hash], sort_keys=True))
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                              (key, json.dumps(to_dict(response), default=str), time.time()))
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if n_entries > self.max_entries:
+                self.conn.execute("DELETE FROM responses WHERE key IN "
+                                  "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                                  (n_entries - self.max_entries,))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,72 @@
+'''Stand-in ollama server that answers /api/generate with a ScriptedBackend, for exercising
+OllamaBackend / RoutingBackend (several hosts, failover, health checks) without a GPU or network.
+Example, two hosts for RoutingBackend(["http://127.0.0.1:11501", "http://127.0.0.1:11502"]):
+    python mock_ollama_server.py --port 11501 --responder hanoi --delay 0.2
+    python mock_ollama_server.py --port 11502 --responder hanoi --delay 0.2
+'''
+import argparse
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_backends import ScriptedBackend, hanoi_oracle_responder, babyai_rule_responder
+
+RESPONDERS = {'hanoi': hanoi_oracle_responder,
+              'babyai': babyai_rule_responder,
+              'echo': lambda prompt, context: " ".join(prompt.split()[-3:])}
+
+def make_handler(backend):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, body, status=200):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            # health checks use /api/tags (ollama.Client.list)
+            if self.path == '/api/tags':
+                self.send_json({'models': []})
+            elif self.path == '/api/version':
+                self.send_json({'version': 'mock'})
+            else:
+                self.send_json({'error': 'not found'}, 404)
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != '/api/generate':
+                self.send_json({'error': 'not found'}, 404)
+                return
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            kwargs = {k: request[k] for k in ['model', 'prompt', 'options', 'context', 'raw', 'logprobs'] if k in request}
+            kwargs['prompt'] = kwargs.get('prompt') or ""
+            if not request.get('stream', True):
+                self.send_json(backend.generate(**kwargs))
+                return
+            # streamed responses are newline delimited json, the connection is closed at the end
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            for chunk in backend.generate_stream(**kwargs):
+                self.wfile.write((json.dumps(chunk) + "\n").encode('utf-8'))
+                self.wfile.flush()
+            self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+    return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=11501)
+    parser.add_argument('--responder', choices=list(RESPONDERS), default='echo')
+    parser.add_argument('--delay', type=float, default=0.0, help='seconds of emulated latency per call')
+    args = parser.parse_args()
+
+    backend = ScriptedBackend(RESPONDERS[args.responder], delay=args.delay)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(backend))
+    print(f"Mock ollama server ({args.responder}) listening on http://127.0.0.1:{args.port}")
+    server.serve_forever()
@@ -1,104 +1,8 @@
-import re
 import json
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import stats
-
-def extract_board_states(buffer_text):
-    """
-    Scans a raw text buffer and returns a list of board strings.
-    
-    Args:
-        buffer_text (str): The full raw text of the replay buffer.
-        
-    Returns:
-        list of str: A list where each element is a clean board string 
-                     ready for parsing.
-    """
-    # Regex Explanation:
-    # 1. \[GAME\] Current Board: \s* -> Matches the header and potential whitespace/newlines
-    # 2. (                            -> Start capturing group for the board content
-    # 3.   A: \[.*?\]\s* -> Matches 'A: [...]' and trailing whitespace
-    # 4.   B: \[.*?\]\s* -> Matches 'B: [...]' and trailing whitespace
-    # 5.   C: \[.*?\]                 -> Matches 'C: [...]'
-    # 6. )                            -> End capturing group
-    # Flags: DOTALL is not strictly needed if we explicitly match newlines, 
-    # but re.MULTILINE helps anchor ^ if needed. Here we keep it simple.
-    
-    pattern = r"\[GAME\] Current Board:\s*(A: \[.*?\]\s*B: \[.*?\]\s*C: \[.*?\])"
-    
-    # re.findall returns all non-overlapping matches in the string
-    matches = re.findall(pattern, buffer_text, re.DOTALL)
-    
-    # Clean up the matches to ensure they look exactly like your example
-    # (removing excess trailing newlines if regex caught them)
-    cleaned_states = [m.strip() for m in matches]
-    
-    return cleaned_states
-
-def parse_board_state(log_string):
-    """
-    Parses the game board string into a dictionary: {'A': [4,3], 'B': [2], 'C': [1]}
-    Assumes lists are ordered [bottom, ..., top] based on your example.
-    """
-    state = {'A': [], 'B': [], 'C': []}
-    
-    # Regex to find lines like "A: [4, 3, 2, 1]"
-    # Matches the letter, then captures the content inside brackets
-    matches = re.findall(r'([ABC]): \[([\d, \-]*)\]', log_string)
-    
-    for peg, content in matches:
-        if content.strip():
-            # Convert "4, 3, 2" string to list of ints [4, 3, 2]
-            # Filter out -1 if your logs sometimes use placeholders
-            disks = [int(x.strip()) for x in content.split(',') if x.strip()]
-            state[peg] = disks
-        else:
-            state[peg] = []
-            
-    return state
-
-def get_disk_location(state, disk_val):
-    for peg in ['A', 'B', 'C']:
-        if disk_val in state[peg]:
-            return peg
-    return None
-
-def calculate_hanoi_distance(state, n_disks=4, target_peg='C'):
-    """
-    Recursively calculates minimum moves to solve from current state.
-    """
-    # Base case
-    if n_disks == 0:
-        return 0
-    
-    # Find where the current largest disk (n) is
-    current_peg = get_disk_location(state, n_disks)
-    
-    # If the disk is missing (error in log parsing?), return error or infinity
-    if current_peg is None:
-        return float('inf') 
-
-    if current_peg == target_peg:
-        # Disk N is already in place. We just need to solve for N-1 on top of it.
-        # Target remains the same.
-        return calculate_hanoi_distance(state, n_disks - 1, target_peg)
-    else:
-        # Disk N is on the wrong peg.
-        # 1. We need to move disks 1..(N-1) to the AUX peg.
-        # 2. Move Disk N (1 move).
-        # 3. Move disks 1..(N-1) from AUX to Target (Known cost: 2^(N-1) - 1).
-        
-        # Determine Auxiliary peg (The one that isn't current or target)
-        pegs = {'A', 'B', 'C'}
-        aux_peg = list(pegs - {current_peg, target_peg})[0]
-        
-        # Recursive step: How many moves to get smaller stack to Aux?
-        moves_to_stack_aux = calculate_hanoi_distance(state, n_disks - 1, aux_peg)
-        
-        # Total = (moves to clear way) + (move disk N) + (move stack back)
-        # Simplified: moves_to_stack_aux + 2^(n-1)
-        return moves_to_stack_aux + (2 ** (n_disks - 1))
+from hanoi_metrics import extract_board_states, parse_board_state, calculate_hanoi_distance
 
 def get_all_distances(buffer):
 
@@ -119,6 +23,15 @@ def get_all_distances(buffer):
         buff_distances.append(distances)
     return buff_distances
 
+def get_record_distances(records):
+    """
+    Same as get_all_distances, for the episode records of an experience store (see load_episode_records):
+    the distances were computed when the episodes were played.
+    """
+    return [[step['distance'] for step in record['steps'] if step['distance'] is not None]
+            + ([record['final_distance']] if record['final_distance'] is not None else [])
+            for record in records]
+
 def plot_distance(data_matrix):
     N_steps = 32
     x_axis = np.arange(N_steps)
@@ -85,4 +85,19 @@ def parse_board(text):
         else:
             state[peg] = []
             
-    return state
\ No newline at end of file
+    return state
+
+def is_legal_move(state_text, move):
+    """
+    Checks a move like "[A C]" against the board in state_text: the source tower must have a disk
+    and it must be smaller than the top disk of the target tower. Without a board, any well-formed move passes.
+    """
+    match = re.fullmatch(r"\[([ABC]) ([ABC])\]", move)
+    if not match or match.group(1) == match.group(2):
+        return False
+    towers = parse_board(state_text)
+    if not any(towers.values()):
+        return True
+    source, target = towers[match.group(1)], towers[match.group(2)]
+    # the right-most disk is the top of a tower
+    return len(source) > 0 and (len(target) == 0 or source[-1] < target[-1])
@@ -0,0 +1,178 @@
+import json
+import os
+import random
+from llm_cache import hash_text
+
+class SumTree:
+    """
+    Binary tree over leaf priorities where every node holds the sum of its children, stored as a flat
+    list (node i has children 2i and 2i + 1, leaves start at capacity). Setting a priority and drawing
+    a leaf with probability proportional to its priority are both O(log n).
+    """
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.tree = [0.0] * (2 * capacity)
+        self.size = 0 # leaves in use
+
+    def total(self):
+        return self.tree[1]
+
+    def get(self, leaf):
+        return self.tree[self.capacity + leaf]
+
+    def set(self, leaf, priority):
+        node = self.capacity + leaf
+        change = priority - self.tree[node]
+        while node >= 1:
+            self.tree[node] += change
+            node //= 2
+
+    def append(self, priority):
+        if self.size == self.capacity:
+            self.grow()
+        self.size += 1
+        self.set(self.size - 1, priority)
+        return self.size - 1
+
+    def grow(self):
+        # doubling keeps appends O(log n) amortized
+        self.rebuild(self.tree[self.capacity:self.capacity + self.size], 2 * self.capacity)
+
+    def compact(self, leaves):
+        """
+        Keeps only the given leaves (in that order) at the smallest capacity that holds them.
+        Returns old leaf -> new leaf.
+        """
+        capacity = 16
+        while capacity < len(leaves):
+            capacity *= 2
+        self.rebuild([self.get(leaf) for leaf in leaves], capacity)
+        return {leaf: i for i, leaf in enumerate(leaves)}
+
+    def rebuild(self, priorities, capacity):
+        self.capacity = capacity
+        self.size = len(priorities)
+        self.tree = [0.0] * (2 * capacity)
+        self.tree[capacity:capacity + len(priorities)] = priorities
+        for node in range(capacity - 1, 0, -1):
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def find(self, value):
+        # walks down to the leaf whose cumulative priority range contains value
+        node = 1
+        while node < self.capacity:
+            if value < self.tree[2 * node] or self.tree[2 * node + 1] <= 0:
+                node = 2 * node
+            else:
+                value -= self.tree[2 * node]
+                node = 2 * node + 1
+        return node - self.capacity
+
+class PrioritizedSampler:
+    """
+    Draws replays with probability proportional to (priority + epsilon) ** alpha, using a SumTree with one
+    leaf per replay (keyed by a hash of its text). priority is one of
+        'progress': the replay's buffer_selection.ReplayScores score,
+        'outcome': 1 for solved replays, 0 otherwise (from the same scores),
+        'recency': doubles every half_life replays, so newer replays are drawn more often.
+    New replays get a leaf the first time the sampler sees them; replays that left the buffer are set to 0,
+    and once those are more than half the leaves the tree is compacted, so a bounded buffer keeps a bounded tree.
+    If path is given, the tree is loaded from that json file and saved whenever it changes.
+    """
+    def __init__(self, path=None, priority='progress', scores=None, alpha=1.0, epsilon=0.01, half_life=50):
+        self.path = path
+        self.priority = priority
+        self.scores = scores
+        self.alpha = alpha
+        self.epsilon = epsilon # keeps every replay reachable
+        self.half_life = half_life
+        self.tree = SumTree()
+        self.leaves = {} # replay hash -> leaf
+        self.keys = [] # leaf -> replay hash, None once the replay left the buffer
+        self.n_added = 0 # replays ever given a leaf, the position recency counts
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def replay_priority(self, replay, position):
+        if self.priority == 'progress':
+            value = self.scores.score(replay)
+        elif self.priority == 'outcome':
+            value = 1.0 if self.scores.add(replay, save=False)['solved'] else 0.0
+        elif self.priority == 'recency':
+            value = 2 ** (position / self.half_life)
+        else:
+            raise ValueError(f"unknown priority {self.priority}")
+        return (value + self.epsilon) ** self.alpha
+
+    def update_priority(self, replay, priority):
+        self.tree.set(self.leaves[hash_text(replay)], (priority + self.epsilon) ** self.alpha)
+
+    def sync(self, buff_list):
+        """
+        Adds a leaf for every replay of buff_list the tree has not seen and zeroes the replays that are gone.
+        Returns a hash -> replay map of the buffer.
+        """
+        by_hash = {hash_text(replay): replay for replay in buff_list}
+        changed = False
+        for replay in buff_list:
+            key = hash_text(replay)
+            if key not in self.leaves:
+                self.leaves[key] = self.tree.append(self.replay_priority(replay, self.n_added))
+                self.keys.append(key)
+                self.n_added += 1
+                changed = True
+        for key in list(self.leaves):
+            if key not in by_hash:
+                leaf = self.leaves.pop(key)
+                self.tree.set(leaf, 0.0)
+                self.keys[leaf] = None
+                changed = True
+        if len(self.leaves) < self.tree.size // 2:
+            # leaves stay in insertion order, so later replays still get the later leaves
+            moved = self.tree.compact(sorted(self.leaves.values()))
+            self.leaves = {key: moved[leaf] for key, leaf in self.leaves.items()}
+            self.keys = [None] * self.tree.size
+            for key, leaf in self.leaves.items():
+                self.keys[leaf] = key
+            changed = True
+        if changed and self.path is not None:
+            self.save()
+        if changed and self.scores is not None:
+            self.scores.save()
+        return by_hash
+
+    def sample(self, buff_list, num_to_select, rng=random):
+        """
+        Draws num_to_select distinct replays of buff_list, O(num_to_select * log n) once the tree is in sync.
+        """
+        by_hash = self.sync(buff_list)
+        drawn = []
+        for _ in range(min(num_to_select, len(by_hash))):
+            leaf = self.tree.find(rng.random() * self.tree.total())
+            drawn.append((leaf, self.tree.get(leaf)))
+            # drawn replays are taken out until the sample is complete, so they are not drawn twice
+            self.tree.set(leaf, 0.0)
+        for leaf, priority in drawn:
+            self.tree.set(leaf, priority)
+        return [by_hash[self.keys[leaf]] for leaf, _ in drawn]
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            stored = json.load(fp)
+        if stored['priority'] != self.priority or stored['alpha'] != self.alpha:
+            print(f"Priorities at {self.path} were computed differently, rebuilding them")
+            return
+        self.tree.capacity = stored['capacity']
+        self.tree.size = stored['size']
+        self.tree.tree = stored['tree']
+        self.leaves = stored['leaves']
+        self.n_added = stored.get('n_added', self.tree.size) # saved before compaction existed
+        self.keys = [None] * self.tree.size
+        for key, leaf in self.leaves.items():
+            self.keys[leaf] = key
+
+    def save(self):
+        with open(self.path, 'w') as fp:
+            json.dump({'priority': self.priority, 'alpha': self.alpha, 'capacity': self.tree.capacity,
+                       'size': self.tree.size, 'tree': self.tree.tree, 'leaves': self.leaves,
+                       'n_added': self.n_added}, fp)
@@ -0,0 +1,124 @@
+import json
+import os
+import zlib
+import numpy as np
+from llm_cache import hash_text
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+def shingles(text, k=5):
+    # overlapping k-word windows of the whitespace normalized text
+    words = text.lower().split()
+    if len(words) <= k:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+class MinHashIndex:
+    """
+    MinHash signatures of replays (num_perm hashes of their k-word shingles), computed once per replay
+    and keyed by a hash of its text, with an LSH index (bands of num_perm / bands rows) to find
+    near-duplicates without comparing every pair. The fraction of equal signature entries estimates the
+    Jaccard similarity of two replays' shingle sets.
+    If path is given, the signatures are loaded from that json file; add() saves them, near_duplicates and
+    mmr_selection save once after signing a whole batch.
+    """
+    def __init__(self, path=None, num_perm=64, bands=16, k=5, seed=0):
+        assert num_perm % bands == 0
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.k = k
+        rng = np.random.RandomState(seed)
+        # random linear hash functions (a * x + b) mod p, one per permutation
+        self.a = rng.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.signatures = {} # replay hash -> signature
+        self.buckets = {} # (band, band values) -> set of replay hashes
+        self.unsaved = 0 # signatures computed since the last save
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def signature(self, text):
+        x = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles(text, self.k)], dtype=np.uint64)
+        # a, b < 2^31 and x < 2^32, so a * x + b stays well inside uint64
+        return ((np.outer(x, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def add(self, replay, save=True):
+        key = hash_text(replay)
+        if key not in self.signatures:
+            self.index(key, self.signature(replay))
+            self.unsaved += 1
+            if save:
+                self.save()
+        return self.signatures[key]
+
+    def index(self, key, signature):
+        self.signatures[key] = signature
+        for band in range(self.bands):
+            values = tuple(signature[band * self.rows:(band + 1) * self.rows].tolist())
+            self.buckets.setdefault((band, values), set()).add(key)
+
+    def similarity(self, replay_a, replay_b):
+        return float(np.mean(self.add(replay_a, save=False) == self.add(replay_b, save=False)))
+
+    def near_duplicates(self, replay, replays, threshold=0.8):
+        """
+        Returns the replays (out of replays) whose estimated Jaccard similarity to replay is at least threshold.
+        """
+        for other in replays:
+            self.add(other, save=False)
+        signature = self.add(replay, save=False)
+        self.save()
+        candidates = set()
+        for band in range(self.bands):
+            values = tuple(signature[band * self.rows:(band + 1) * self.rows].tolist())
+            candidates |= self.buckets.get((band, values), set())
+        candidates.discard(hash_text(replay))
+        return [other for other in replays if hash_text(other) in candidates
+                and np.mean(self.signatures[hash_text(other)] == signature) >= threshold]
+
+    def load(self):
+        with open(self.path, 'r') as fp:
+            stored = json.load(fp)
+        if stored['num_perm'] != self.num_perm or stored['k'] != self.k:
+            print(f"MinHash signatures at {self.path} use other settings, recomputing them")
+            return
+        for key, signature in stored['signatures'].items():
+            self.index(key, np.array(signature, dtype=np.uint64))
+
+    def save(self):
+        if self.path is None or self.unsaved == 0:
+            return
+        # written to a temporary file first, so a crash never leaves a half written file behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as fp:
+            json.dump({'num_perm': self.num_perm, 'k': self.k,
+                       'signatures': {key: sig.tolist() for key, sig in self.signatures.items()}}, fp)
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+
+def mmr_selection(ranked, num_to_select, minhash, trade_off=0.5, threshold=0.8):
+    """
+    Maximal marginal relevance: walks the candidates best first (ranked) and each time picks the one with
+    the best mix of relevance (its rank) and novelty (1 - its highest similarity to what is already picked).
+    Near-duplicates (similarity >= threshold) of a picked replay are only used if nothing else is left.
+    """
+    relevance = {i: 1 - i / len(ranked) for i in range(len(ranked))}
+    selected, duplicates = [], []
+    remaining = list(range(len(ranked)))
+    while remaining and len(selected) < num_to_select:
+        best, best_value, best_similarity = None, None, 0.0
+        for i in remaining:
+            similarity = max((minhash.similarity(ranked[i], ranked[j]) for j in selected), default=0.0)
+            value = trade_off * relevance[i] - (1 - trade_off) * similarity
+            if best is None or value > best_value:
+                best, best_value, best_similarity = i, value, similarity
+        remaining.remove(best)
+        if best_similarity >= threshold:
+            duplicates.append(best)
+        else:
+            selected.append(best)
+    selected += duplicates[:num_to_select - len(selected)]
+    minhash.save()
+    return [ranked[i] for i in selected]
@@ -0,0 +1,81 @@
+import re
+from hanoi_metrics import extract_board_states, parse_board_state
+
+BABYAI_ACTION_REQUEST = r"\nNow select one of the following options: .*?Your selected output action is "
+
+def count_tokens(text):
+    # rough tokenizer-free estimate: every word and every punctuation mark is a token
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+def format_board(state):
+    return " ".join(f"{peg}: {state[peg]}" for peg in ['A', 'B', 'C'])
+
+def board_move(before, after):
+    # the move that turns one board into the next, found by which towers lost and gained a disk
+    if before == after:
+        return "(no change)"
+    sources = [peg for peg in before if len(after[peg]) == len(before[peg]) - 1]
+    targets = [peg for peg in before if len(after[peg]) == len(before[peg]) + 1]
+    if len(sources) == 1 and len(targets) == 1:
+        return f"{sources[0]} {targets[0]}"
+    return "?"
+
+def encode_hanoi_replay(text, snapshot_every=8):
+    """
+    Rewrites a Tower of Hanoi transcript as the starting board, the list of moves (derived from consecutive
+    boards) with a board snapshot every snapshot_every moves, the final board and the closing line
+    (the outcome the runner appends). Returns text unchanged if it holds no boards.
+    """
+    boards = [parse_board_state(board) for board in extract_board_states(text)]
+    if len(boards) == 0:
+        return text
+    moves = [board_move(before, after) for before, after in zip(boards, boards[1:])]
+
+    lines = [f"Start: {format_board(boards[0])}"]
+    for start in range(0, len(moves), snapshot_every):
+        end = min(start + snapshot_every, len(moves))
+        lines.append(f"Moves {start + 1}-{end}: " + ", ".join(moves[start:end]))
+        lines.append(f"Board after move {end}: {format_board(boards[end])}")
+    last_line = text.strip().splitlines()[-1].strip()
+    if not re.match(r"[ABC]: \[", last_line):
+        lines.append(f"Outcome: {last_line}")
+    return "\n".join(lines)
+
+def encode_babyai_replay(text):
+    """
+    Rewrites a BabyAI-Text run (as stored by curriculum_babyai.py) as its header, the mission and one
+    'step | what you saw | action' row per step, without the repeated action request, and with
+    observations identical to the previous step shortened to 'same'. Returns text unchanged if it
+    does not look like such a run.
+    """
+    mission = re.search(r"Your mission is to (.*?)\n", text)
+    segments = re.split(BABYAI_ACTION_REQUEST, text)
+    if mission is None or len(segments) < 2:
+        return text
+    header = text[:mission.start()].strip()
+    observation = segments[0][mission.end():].strip()
+
+    lines = ([header] if header else []) + [f"Mission: {mission.group(1)}", "step | what you saw | action"]
+    previous = None
+    for step, segment in enumerate(segments[1:]):
+        # every segment is the chosen action, then what was seen after it (or how the run ended)
+        action, _, following = segment.partition("\n")
+        lines.append(f"{step + 1} | {'same' if observation == previous else observation} | {action.strip()}")
+        previous, observation = observation, following.strip()
+    if observation:
+        lines.append(f"Outcome: {observation}")
+    return "\n".join(lines)
+
+def encode_replay(text, env_id):
+    if "TowerOfHanoi-v0" in env_id:
+        return encode_hanoi_replay(text)
+    elif "BabyAI-" in env_id:
+        return encode_babyai_replay(text)
+    return text
+
+def encoding_report(raw_runs, encoded_runs):
+    raw_tokens = sum(count_tokens(run) for run in raw_runs)
+    encoded_tokens = sum(count_tokens(run) for run in encoded_runs)
+    return {'raw_tokens': raw_tokens,
+            'encoded_tokens': encoded_tokens,
+            'saved_fraction': 1 - encoded_tokens / raw_tokens if raw_tokens > 0 else 0.0}
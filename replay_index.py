@@ -0,0 +1,87 @@
+import os
+import zlib
+import numpy as np
+import ollama
+from llm_cache import hash_text
+
+def hashed_ngrams(texts, dim=1024, n=3):
+    """
+    Cheap offline embedding: counts of the character n-grams of each (lower-cased, whitespace collapsed)
+    text, hashed into dim buckets. Enough to tell missions, objects and board layouts apart without a model.
+    """
+    vectors = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        text = " ".join(text.lower().split())
+        for i in range(len(text) - n + 1):
+            vectors[row, zlib.crc32(text[i:i + n].encode('utf-8')) % dim] += 1
+    # dampen very frequent n-grams so long replays are not dominated by boilerplate
+    return np.log1p(vectors)
+
+class ReplayIndex:
+    """
+    Embedding matrix of the replays of an experience cache, for nearest neighbour retrieval.
+    Each replay is embedded once, keyed by a hash of its text, with embed_model on the ollama server
+    (e.g. 'nomic-embed-text') or with hashed_ngrams when embed_model is None.
+    If path is given (an .npz file), the index is loaded from and saved to it; vectors from a different
+    embedder are thrown away on load.
+    """
+    def __init__(self, path=None, embed_model=None, dim=1024, host=None):
+        self.path = path
+        self.embed_model = embed_model
+        self.dim = dim
+        self.embedder = embed_model if embed_model is not None else f"hashed-ngrams-{dim}"
+        self.client = ollama.Client(host=host) if embed_model is not None else None
+        self.hashes = []
+        self.rows = {} # replay hash -> row of vectors
+        self.vectors = None # (n replays, embedding size), rows normalized to unit length
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def embed(self, texts):
+        if self.embed_model is None:
+            vectors = hashed_ngrams(texts, self.dim)
+        else:
+            vectors = np.asarray(self.client.embed(model=self.embed_model, input=texts)['embeddings'], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def add(self, replays):
+        # only replays that are not in the index yet are embedded
+        new = {}
+        for replay in replays:
+            key = hash_text(replay)
+            if key not in self.rows and key not in new:
+                new[key] = replay
+        if len(new) == 0:
+            return 0
+        vectors = self.embed(list(new.values()))
+        self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+        for key in new:
+            self.rows[key] = len(self.hashes)
+            self.hashes.append(key)
+        if self.path is not None:
+            self.save()
+        return len(new)
+
+    def search(self, query, replays, k):
+        """
+        Returns the k replays (out of replays) most similar to query, most similar first.
+        """
+        if len(replays) == 0 or k <= 0:
+            return []
+        self.add(replays)
+        scores = self.vectors[[self.rows[hash_text(replay)] for replay in replays]] @ self.embed([query])[0]
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [replays[i] for i in order]
+
+    def load(self):
+        stored = np.load(self.path)
+        if str(stored['embedder']) != self.embedder:
+            print(f"Replay index at {self.path} was built with {stored['embedder']}, rebuilding it with {self.embedder}")
+            return
+        self.vectors = stored['vectors']
+        self.hashes = [str(h) for h in stored['hashes']]
+        self.rows = {h: i for i, h in enumerate(self.hashes)}
+
+    def save(self):
+        np.savez(self.path, vectors=self.vectors, hashes=np.array(self.hashes), embedder=np.array(self.embedder))
@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from llm_cache import hash_text
+from hanoi_metrics import extract_board_states, replay_quality
+from episode_record import EpisodeText, BABYAI_HEADERS
+from replay_encoding import BABYAI_ACTION_REQUEST
+from experience_store import ExperienceStore
+
+def replay_metadata(replay, env_id=None, model=None):
+    """
+    What the replay store indexes about a replay: env_id, n_disks (Tower of Hanoi only), model, outcome
+    ('success' or 'failure'), n_steps and length (characters). Recorded episodes carry all of it; for plain
+    transcripts it is read off the text, with env_id and model taken from the arguments when given.
+    """
+    if isinstance(replay, EpisodeText):
+        record = replay.record
+        env_id = record['env_id']
+        model = record['model']['model_name']
+        n_steps = len(record['steps'])
+        if "TowerOfHanoi-v0" in env_id:
+            n_disks = record['env_params'].get('num_disks')
+            success = record.get('final_distance') == 0
+        else:
+            n_disks = None
+            success = record['termination'] == 'success'
+    elif (env_id is not None and "BabyAI-" in env_id) or (env_id is None and "Your mission is to" in replay):
+        # the exact BabyAI env is not in the text
+        env_id = env_id or "BabyAI"
+        n_disks = None
+        n_steps = len(re.findall(BABYAI_ACTION_REQUEST, replay))
+        success = replay.startswith(BABYAI_HEADERS['success'])
+    else:
+        boards = extract_board_states(replay)
+        env_id = env_id or ("TowerOfHanoi-v0" if boards else None)
+        # every disk is on some peg, so the first board tells how many there are
+        n_disks = len(re.findall(r"\d+", boards[0])) if boards else None
+        n_steps = max(len(boards) - 1, 0)
+        success = n_disks is not None and replay_quality(replay, n_disks)['solved']
+    return {'env_id': env_id,
+            'n_disks': n_disks,
+            'model': model,
+            'outcome': 'success' if success else 'failure',
+            'n_steps': n_steps,
+            'length': len(replay)}
+
+class ReplayStore:
+    """
+    One SQLite database for the replays of every cache, each stored once under the hash of its text,
+    with an index on env, disks, model, outcome and length. A cache becomes a named view (an ordered list
+    of hashes), so a condition is assembled by a query or by combining views instead of concatenating
+    json files by hand. Recorded episodes (episode_record.EpisodeText) keep their record.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS replays (hash TEXT PRIMARY KEY, text TEXT, record TEXT, "
+                          "env_id TEXT, n_disks INTEGER, model TEXT, outcome TEXT, n_steps INTEGER, length INTEGER, added REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS views (name TEXT, position INTEGER, hash TEXT, PRIMARY KEY (name, position))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replays_condition ON replays (env_id, n_disks, outcome)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replays_model ON replays (model)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS replays_n_steps ON replays (n_steps)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS views_hash ON views (hash)")
+        self.conn.commit()
+
+    def insert(self, replay, env_id=None, model=None):
+        key = hash_text(replay)
+        meta = replay_metadata(replay, env_id, model)
+        record = json.dumps(replay.record) if isinstance(replay, EpisodeText) else None
+        # a replay already stored keeps its row, only a missing record is filled in
+        self.conn.execute("INSERT OR IGNORE INTO replays VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                          (key, str(replay), record, meta['env_id'], meta['n_disks'], meta['model'],
+                           meta['outcome'], meta['n_steps'], meta['length'], time.time()))
+        if record is not None:
+            self.conn.execute("UPDATE replays SET record = ? WHERE hash = ? AND record IS NULL", (record, key))
+        return key
+
+    def add(self, replay, view=None, env_id=None, model=None):
+        """
+        Stores replay (if it is not stored yet) and appends it to view if given. Returns its hash.
+        """
+        with self.lock:
+            key = self.insert(replay, env_id, model)
+            if view is not None:
+                # after the last position rather than at the count, which repeats a position once one was removed
+                self.conn.execute("INSERT INTO views VALUES (?, (SELECT COALESCE(MAX(position) + 1, 0) FROM views "
+                                  "WHERE name = ?), ?)", (view, view, key))
+            self.conn.commit()
+        return key
+
+    def remove_from_view(self, view, key):
+        """
+        Drops the first entry of view with hash key, e.g. a replay the experience buffer evicted.
+        The replay itself stays in the store.
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM views WHERE rowid = (SELECT rowid FROM views WHERE name = ? AND hash = ? "
+                              "ORDER BY position LIMIT 1)", (view, key))
+            self.conn.commit()
+
+    def add_view(self, name, replays, env_id=None, model=None):
+        """
+        Stores replays and makes name a view of them, in order (replacing any view of that name).
+        """
+        with self.lock:
+            keys = [self.insert(replay, env_id, model) for replay in replays]
+            self.conn.execute("DELETE FROM views WHERE name = ?", (name,))
+            self.conn.executemany("INSERT INTO views VALUES (?, ?, ?)", [(name, i, key) for i, key in enumerate(keys)])
+            self.conn.commit()
+        return keys
+
+    def import_cache(self, path, name=None, env_id=None, model=None):
+        """
+        Adds an experience cache (a json list, or the .jsonl store next to it if there is one) as a view
+        named after the file unless name is given. Returns how many of its replays were new to the store.
+        """
+        name = name or os.path.splitext(os.path.basename(path))[0]
+        replays = ExperienceStore(path.replace('.json', '.jsonl'), legacy_path=path).load()
+        with self.lock:
+            before = self.conn.execute("SELECT COUNT(*) FROM replays").fetchone()[0]
+        self.add_view(name, replays, env_id, model)
+        with self.lock:
+            after = self.conn.execute("SELECT COUNT(*) FROM replays").fetchone()[0]
+        return after - before
+
+    def rows_to_replays(self, rows):
+        return [EpisodeText(json.loads(record)) if record is not None else text for text, record in rows]
+
+    def view(self, *names):
+        """
+        The replays of one or more views, in order, each replay once.
+        """
+        replays, seen = [], set()
+        with self.lock:
+            for name in names:
+                rows = self.conn.execute("SELECT replays.hash, text, record FROM views JOIN replays USING (hash) "
+                                         "WHERE name = ? ORDER BY position", (name,)).fetchall()
+                for key, text, record in rows:
+                    if key not in seen:
+                        seen.add(key)
+                        replays.append((text, record))
+        return self.rows_to_replays(replays)
+
+    def query(self, env_id=None, n_disks=None, model=None, outcome=None, min_steps=None, max_steps=None,
+              views=None, limit=None):
+        """
+        The stored replays matching every given condition, oldest first, e.g.
+        query(n_disks=4, outcome='success') for the 4-disk successes of every cache.
+        views restricts the search to replays in any of those views.
+        """
+        conditions, params = [], []
+        for column, value in [('env_id', env_id), ('n_disks', n_disks), ('model', model), ('outcome', outcome)]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if min_steps is not None:
+            conditions.append("n_steps >= ?")
+            params.append(min_steps)
+        if max_steps is not None:
+            conditions.append("n_steps <= ?")
+            params.append(max_steps)
+        if views is not None:
+            conditions.append(f"hash IN (SELECT hash FROM views WHERE name IN ({', '.join('?' * len(views))}))")
+            params += list(views)
+        sql = "SELECT text, record FROM replays"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY added, rowid"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return self.rows_to_replays(rows)
+
+    def views(self):
+        with self.lock:
+            return dict(self.conn.execute("SELECT name, COUNT(*) FROM views GROUP BY name ORDER BY name").fetchall())
+
+    def summary(self):
+        with self.lock:
+            n_replays = self.conn.execute("SELECT COUNT(*) FROM replays").fetchone()[0]
+            n_entries = self.conn.execute("SELECT COUNT(*) FROM views").fetchone()[0]
+            conditions = self.conn.execute("SELECT env_id, n_disks, outcome, COUNT(*) FROM replays "
+                                           "GROUP BY env_id, n_disks, outcome ORDER BY env_id, n_disks, outcome").fetchall()
+        return {'replays': n_replays,
+                'view_entries': n_entries, # replays counted once per view they are in
+                'conditions': [{'env_id': e, 'n_disks': d, 'outcome': o, 'replays': n} for e, d, o, n in conditions]}
+
+    def print_summary(self):
+        s = self.summary()
+        print(f"Replay store {self.path}: {s['replays']} unique replays for {s['view_entries']} view entries")
+        for c in s['conditions']:
+            print(f"  {c['env_id']} disks={c['n_disks']} {c['outcome']}: {c['replays']}")
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    # e.g. python replay_store.py replays.db hanoi_caches/*.json --model Llama3.1:8b
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db', help='sqlite file of the replay store, created if missing')
+    parser.add_argument('caches', nargs='*', help='experience cache json files to import as views')
+    parser.add_argument('--env-id', default=None, help='env of the imported caches, guessed from the replays if not given')
+    parser.add_argument('--model', default=None, help='model that played the imported caches')
+    args = parser.parse_args()
+
+    store = ReplayStore(args.db)
+    for cache in args.caches:
+        new = store.import_cache(cache, env_id=args.env_id, model=args.model)
+        print(f"Imported {cache}: {new} new replays")
+    store.print_summary()
+    store.close()
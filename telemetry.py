@@ -0,0 +1,94 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+
+# token counts and server side timings (nanoseconds) that ollama reports with every response
+RESPONSE_FIELDS = ['prompt_eval_count', 'eval_count', 'prompt_eval_duration', 'eval_duration', 'load_duration', 'total_duration']
+
+def percentile(values, q):
+    # nearest-rank percentile, values must be sorted
+    if len(values) == 0:
+        return 0.0
+    rank = max(math.ceil(q / 100 * len(values)), 1)
+    return values[rank - 1]
+
+class LLMTelemetry:
+    """
+    Records the token counts and timings of every LLM call, tagged with e.g. env, model, episode and step.
+    Each record is appended to a JSONL file (if path is given) and kept in memory so summary() can report
+    latency percentiles, throughput and tokens per episode for the run.
+    Tags given to the constructor or set_tags() apply to every following record.
+    """
+    def __init__(self, path=None, **tags):
+        self.path = path
+        self.tags = tags
+        self.records = []
+        self.lock = threading.Lock()
+        self.fp = open(path, 'a') if path is not None else None
+
+    def set_tags(self, **tags):
+        self.tags.update(tags)
+
+    def record(self, response, latency, **tags):
+        entry = {'time': time.time(), **self.tags, **tags}
+        for field in RESPONSE_FIELDS:
+            entry[field] = response.get(field) or 0
+        entry['cached'] = bool(response.get('cached', False))
+        entry['attempts'] = response.get('attempts') or 1 # set by ResilientBackend
+        entry['hedged'] = bool(response.get('hedged', False))
+        entry['latency'] = latency # wall clock seconds seen by the client, queueing and network included
+        with self.lock:
+            self.records.append(entry)
+            if self.fp is not None:
+                self.fp.write(json.dumps(entry, default=str) + "\n")
+                self.fp.flush()
+        return entry
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+        # cache hits never reach the server, so they would only flatter the latency numbers
+        calls = [r for r in records if not r['cached']]
+        # model loading is reported on its own instead of inflating the per step latency
+        latencies = sorted(r['latency'] for r in calls if r.get('phase') != 'load')
+        eval_tokens = sum(r['eval_count'] for r in calls)
+        eval_seconds = sum(r['eval_duration'] for r in calls) / 1e9
+        prompt_tokens = sum(r['prompt_eval_count'] for r in calls)
+        prompt_seconds = sum(r['prompt_eval_duration'] for r in calls) / 1e9
+
+        episode_tokens = defaultdict(int)
+        for r in calls:
+            if r.get('episode') is not None:
+                episode_tokens[r['episode']] += r['prompt_eval_count'] + r['eval_count']
+
+        return {'calls': len(records),
+                'cached_calls': len(records) - len(calls),
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95),
+                'latency_p99': percentile(latencies, 99),
+                'retries': sum(r.get('attempts', 1) - 1 for r in calls),
+                'hedged_calls': sum(r.get('hedged', False) for r in calls),
+                'prompt_tokens': prompt_tokens,
+                'decode_tokens': eval_tokens,
+                'prompt_tokens_per_sec': prompt_tokens / prompt_seconds if prompt_seconds > 0 else 0.0,
+                'decode_tokens_per_sec': eval_tokens / eval_seconds if eval_seconds > 0 else 0.0,
+                'tokens_per_episode': sum(episode_tokens.values()) / len(episode_tokens) if episode_tokens else 0.0,
+                'load_seconds': sum(r['load_duration'] for r in calls) / 1e9,
+                'warmup_seconds': sum(r['latency'] for r in calls if r.get('phase') == 'load')}
+
+    def print_summary(self):
+        s = self.summary()
+        print(f"LLM calls: {s['calls']} ({s['cached_calls']} served from cache)")
+        print(f"Latency p50 {s['latency_p50']:.2f}s, p95 {s['latency_p95']:.2f}s, p99 {s['latency_p99']:.2f}s "
+              f"({s['retries']} retries, {s['hedged_calls']} hedged calls)")
+        print(f"Model load {s['load_seconds']:.2f}s, warmup {s['warmup_seconds']:.2f}s")
+        print(f"Prompt eval {s['prompt_tokens']} tokens at {s['prompt_tokens_per_sec']:.1f} tok/s, "
+              f"decode {s['decode_tokens']} tokens at {s['decode_tokens_per_sec']:.1f} tok/s")
+        print(f"Tokens per episode: {s['tokens_per_episode']:.0f}")
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
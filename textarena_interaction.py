@@ -1,48 +1,35 @@
 import textarena as ta
-from agent import AgentLLM
+from agent import ContextAgentLLM
 import re
-import ollama
-import json
 from enum import Enum
+from experience_buffer import ExperienceBuffer
+from experience_store import ExperienceStore
 
 class Models(Enum):
     PHI = "phi3:3.8b"
     QWEN = "qwen3:4b"
     GEMMA = "gemma3:4b"
 
-class ContextAgentLLM:
-    def __init__(self, model_name, context_size, temperature, max_tokens):
-        super().__init__()
-        self.model_name = model_name
-        self.options = {'num_ctx': context_size, # max number of tokens allowed in context
-                        'temperature': temperature, # sampling temperature
-                        'num_predict': max_tokens, # max number of decoded tokens before interrupt
-                        'keep_alive': -1
-                        } 
-    
-    def get_action(self, prompt, context):
-        return ollama.generate(model=self.model_name,
-                        prompt=prompt,
-                        options=self.options,
-                        context = context)
-    
 class TestEnv():
-    def __init__(self, env_id, agent, cache_file="experience_cache.json"):
+    def __init__(self, env_id, agent, cache_file="experience_cache.json", buffer_capacity=None, eviction_policy='fifo'):
         self.env_id = env_id
         self.agent = agent
         self.cache_file = cache_file
         self.cache_path = "./cache/"
+        self.buffer_capacity = buffer_capacity # most experiences kept, None to keep every one
+        self.eviction_policy = eviction_policy # see experience_buffer.ExperienceBuffer
         self.get_experience_cache()
 
     def get_experience_cache(self):
         file_path = self.cache_path+self.cache_file
-        with open(file_path, 'r') as fp:
-            self.experience_cache = json.load(fp)
+        # experiences are appended to the .jsonl store as they are added, the .json file is a snapshot of it
+        self.experience_store = ExperienceStore(file_path.replace('.json', '.jsonl'), legacy_path=file_path)
+        self.experience_cache = ExperienceBuffer(self.experience_store.load(), self.buffer_capacity, self.eviction_policy,
+                                                 store=self.experience_store)
 
     def save_experience_cache(self):
         file_path = self.cache_path+self.cache_file
-        with open(file_path, 'w') as fp:
-            json.dump(self.experience_cache, fp, indent=2)
+        self.experience_store.export(self.experience_cache, file_path)
     
     def add_to_experience_cache(self, addition):
         self.experience_cache.append(addition)
@@ -51,19 +38,22 @@ class TestEnv():
         pass
 
     def run(self, rounds=5, update_cache=True, **kwargs):
+        if (not update_cache): self.experience_cache.store = None # keep this run's experiences in memory only
         for episode in range(rounds):
             (save, experience) = self.run_round(episode+1, **kwargs)
             if (save): self.add_to_experience_cache(experience)
         
         if (update_cache): self.save_experience_cache()
+        self.experience_cache.store = self.experience_store
 
 class TowerOfHanoiTestEnv(TestEnv):
     
-    def __init__(self, agent, num_disks=4, max_turns=25, cache_file="experience_cache.json"):
+    def __init__(self, agent, num_disks=4, max_turns=25, cache_file="experience_cache.json", buffer_capacity=None,
+                 eviction_policy='fifo'):
         self.env_id = "TowerOfHanoi-v0"
         self.num_disks = num_disks
         self.max_turns = max_turns
-        super().__init__(self.env_id, agent, cache_file)
+        super().__init__(self.env_id, agent, cache_file, buffer_capacity, eviction_policy)
 
     def extract_isolated_pair(self, text):
         # Define the pattern: